@@ -2,98 +2,230 @@
 # -*- coding: utf-8 -*-
 
 import dbus
-import datetime
 import time
 from utils import private_bus
-from ve_utils import wrap_dbus_value, unwrap_dbus_value
+from ve_utils import wrap_dbus_value
+from vedbus import VeDbusItemImport
 import logging
 import os
 from math import floor
+from functools import partial
+import struct
+import zlib
 
 log = logging.getLogger()
 
+# Les index de charge et de décharge sont écrits dans le bus au plus une fois par
+# WRITE_INTERVAL secondes, sauf s'ils ont varié d'au moins WRITE_THRESHOLD kWh (1 Wh)
+WRITE_INTERVAL = 1
+WRITE_THRESHOLD = 0.001
+
+# Sans nouvel échantillon pendant HOLD_INTERVAL secondes, la puissance est considérée
+# constante depuis le dernier échantillon et l'intégration est faite jusqu'à maintenant
+HOLD_INTERVAL = 5
+
+# Les index sont sauvegardés dans le journal toutes les CHECKPOINT_INTERVAL secondes
+# s'ils ont changé, pour limiter l'usure de la mémoire flash
+INDEX_DIR = '/data/home/root/venus.dbus-homedub'
+JOURNAL_FILE = os.path.join(INDEX_DIR, 'index_journal')
+CHECKPOINT_INTERVAL = 600
+
+# Journal des index de charge et de décharge
+# Le fichier contient deux enregistrements de taille fixe (numéro de séquence, index
+# chargé, index déchargé, crc32) écrits alternativement, avec un fsync à chaque écriture
+# Une écriture interrompue (coupure de courant, arrêt par le watchdog) ne peut abîmer
+# que l'enregistrement en cours d'écriture : l'autre reste valide et est relu au démarrage
+class IndexJournal(object):
+	record = struct.Struct('<Qdd')
+	crc = struct.Struct('<I')
+	size = record.size + crc.size
+
+	def __init__(self, path=JOURNAL_FILE):
+		self.path = path
+		self.seq = 0
+
+	# Retourne les derniers index (chargé, déchargé) valides, ou None si aucun
+	def recover(self):
+		try:
+			with open(self.path, 'rb') as f:
+				data = f.read(2 * self.size)
+		except IOError:
+			return None
+		best = None
+		for i in range(2):
+			slot = data[i * self.size:(i + 1) * self.size]
+			if len(slot) < self.size:
+				continue
+			body = slot[:self.record.size]
+			if self.crc.unpack(slot[self.record.size:])[0] != zlib.crc32(body):
+				continue
+			seq, charged, discharged = self.record.unpack(body)
+			if best is None or seq > best[0]:
+				best = (seq, charged, discharged)
+		if best is None:
+			return None
+		self.seq = best[0]
+		return best[1], best[2]
+
+	def commit(self, charged, discharged):
+		self.seq += 1
+		body = self.record.pack(self.seq, charged, discharged)
+		fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+		try:
+			os.pwrite(fd, body + self.crc.pack(zlib.crc32(body)), (self.seq % 2) * self.size)
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+# Intégration de la puissance par la méthode des trapèzes
+# Chaque échantillon de tension et de courant est horodaté avec time.monotonic() à son
+# arrivée, ce qui ne dépend pas des changements d'heure (TZ, NTP)
+# Les énergies sont retournées en kWh, séparément pour la charge et la décharge
+class EnergyIntegrator(object):
+	def __init__(self, voltage=0, current=0):
+		self.voltage = voltage
+		self.current = current
+		self.time = None
+		self.power = voltage * current
+
+	# Ajouter un échantillon pris au temps t, seule la valeur qui a changé peut être passée
+	def sample(self, t, voltage=None, current=None):
+		if voltage is not None:
+			self.voltage = voltage
+		if current is not None:
+			self.current = current
+		return self.advance(t, self.voltage * self.current)
+
+	# Maintenir la puissance du dernier échantillon jusqu'au temps t
+	def hold(self, t):
+		return self.advance(t, self.power)
+
+	def advance(self, t, power):
+		t0, p0 = self.time, self.power
+		self.time, self.power = t, power
+		if t0 is None or t <= t0:
+			return 0, 0
+		dt = t - t0
+		if p0 * power >= 0:
+			return self.split((p0 + power) * dt / 2)
+		# la puissance change de signe dans l'intervalle : on coupe le trapèze au passage par zéro
+		tz = dt * p0 / (p0 - power)
+		c0, d0 = self.split(p0 * tz / 2)
+		c1, d1 = self.split(power * (dt - tz) / 2)
+		return c0 + c1, d0 + d1
+
+	# Convertir une énergie en Ws en kWh chargés et déchargés
+	def split(self, energy):
+		energy /= 3600000
+		if energy > 0:
+			return energy, 0
+		return 0, -energy
+
 class BatteryMonitor(object):
-	def __init__(self, dbusConn):
+	def __init__(self, dbusConn, checkpointInterval=CHECKPOINT_INTERVAL):
 		self.bus=dbusConn
 		self.dbusName='com.victronenergy.battery.socketcan_can0'
 		self.dbusObjects={
-			'voltage' : {'path' : '/Dc/0/Voltage', 'value' : 0, 'proxy' : None},
-			'current' : {'path' : '/Dc/0/Current', 'value' : 0, 'proxy' : None},
-			'charged' : {'path' : '/History/ChargedEnergy', 'value' : 0, 'proxy' : None},
-			'discharged' : {'path' : '/History/DischargedEnergy', 'value' : 0, 'proxy' : None}
+			'voltage' : {'path' : '/Dc/0/Voltage', 'value' : 0, 'item' : None},
+			'current' : {'path' : '/Dc/0/Current', 'value' : 0, 'item' : None},
+			'charged' : {'path' : '/History/ChargedEnergy', 'value' : 0, 'proxy' : None, 'written' : None},
+			'discharged' : {'path' : '/History/DischargedEnergy', 'value' : 0, 'proxy' : None, 'written' : None}
 			}
-		self.previousTime = None
+		self.integrator = None
+		self.writeTime = 0
+		self.journal = IndexJournal()
+		self.checkpointInterval = checkpointInterval
+		self.checkpointTime = 0
+		self.checkpointValues = None
 
 	# Fonction pour initialiser les valeurs de l'objet dbusObjects
 	# A appeler après la création de l'objet
 	# Si les valeurs ChargedEnergy et DischargedEnergy sont à none, on initialise les valeurs dans le dbus à 0
 	# On récupère aussi le temps système
+	# La tension et le courant ne sont pas lus à chaque cycle : on s'abonne à leurs
+	# changements (ItemsChanged/PropertiesChanged) et l'énergie est intégrée à chaque changement
 	def init(self):
-		# initialiser les proxy
-		for name, dbusObject in self.dbusObjects.items():
+		# initialiser les proxy des index et les abonnements à la tension et au courant
+		for name in ('charged', 'discharged'):
+			dbusObject = self.dbusObjects[name]
 			dbusObject['proxy'] = self.bus.get_object(self.dbusName, dbusObject['path'], introspect=False)
-		# initialiser les index de charge et de décharge
-		if os.path.isfile('/data/home/root/venus.dbus-homedub/index_charged'):
-			f = open("/data/home/root/venus.dbus-homedub/index_charged", "r")
-			charged_index=float(f.read())
-			f.close()
-			if isinstance (charged_index, (float)):
-				self.dbusObjects['charged']['value'] = charged_index
-				self.dbusObjects['charged']['proxy'].SetValue(wrap_dbus_value(charged_index))
-		if os.path.isfile('/data/home/root/venus.dbus-homedub/index_discharged'):
-			f = open("/data/home/root/venus.dbus-homedub/index_discharged", "r")
-			discharged_index=float(f.read())
-			f.close()
-			if isinstance (discharged_index, (float)):
-				self.dbusObjects['discharged']['value'] = discharged_index
-				self.dbusObjects['discharged']['proxy'].SetValue(wrap_dbus_value(discharged_index))
-		self.dbusObjects['voltage']['value'] = unwrap_dbus_value(self.dbusObjects['voltage']['proxy'].GetValue())
-		self.dbusObjects['current']['value'] = unwrap_dbus_value(self.dbusObjects['current']['proxy'].GetValue())
-		self.previousTime = datetime.datetime.now()
+		for name in ('voltage', 'current'):
+			dbusObject = self.dbusObjects[name]
+			dbusObject['item'] = VeDbusItemImport(self.bus, self.dbusName, dbusObject['path'],
+				eventCallback=partial(self.valueChanged, name))
+		# initialiser les index de charge et de décharge avec le dernier point de sauvegarde
+		# valide du journal, ou à défaut avec les fichiers des versions précédentes
+		indexes = self.journal.recover()
+		if indexes is None:
+			indexes = (self.loadIndex('index_charged'), self.loadIndex('index_discharged'))
+		else:
+			self.checkpointValues = indexes
+		for name, index in zip(('charged', 'discharged'), indexes):
+			if isinstance (index, (float)):
+				self.dbusObjects[name]['value'] = index
+				self.dbusObjects[name]['proxy'].SetValue(wrap_dbus_value(index))
+				self.dbusObjects[name]['written'] = index
+		self.checkpointTime = time.monotonic()
+		self.dbusObjects['voltage']['value'] = self.dbusObjects['voltage']['item'].get_value() or 0
+		self.dbusObjects['current']['value'] = self.dbusObjects['current']['item'].get_value() or 0
+		self.integrator = EnergyIntegrator(self.dbusObjects['voltage']['value'], self.dbusObjects['current']['value'])
+		self.integrator.sample(time.monotonic())
 		log.debug('Battery monitor initialized')
 
-	# Fonction pour écrire les valeurs des index de charge et de décharge dans des fichiers
-	# A appeler lors de l'arrêt du programme homedub.py
+	# Lire un index sauvegardé par les versions précédentes dans un fichier texte
+	def loadIndex(self, name):
+		path = os.path.join(INDEX_DIR, name)
+		if not os.path.isfile(path):
+			return None
+		with open(path, 'r') as f:
+			return float(f.read())
+
+	# Fonction pour écrire les valeurs des index de charge et de décharge dans le journal
+	# Appelée périodiquement par update et lors de l'arrêt du programme homedub.py
 	def save(self):
-		charged_index=self.dbusObjects['charged']['value']
-		f = open("/data/home/root/venus.dbus-homedub/index_charged", "w")
-		f.write(str(charged_index))
-		f.close()
-		discharged_index=self.dbusObjects['discharged']['value']
-		f = open("/data/home/root/venus.dbus-homedub/index_discharged", "w")
-		f.write(str(discharged_index))
-		f.close()
+		values = (self.dbusObjects['charged']['value'], self.dbusObjects['discharged']['value'])
+		self.checkpointTime = time.monotonic()
+		if values == self.checkpointValues:
+			return
+		self.journal.commit(*values)
+		self.checkpointValues = values
+
+	# Fonction appelée à chaque changement de la tension ou du courant
+	# L'échantillon est horodaté à son arrivée et l'énergie intégrée jusqu'à lui
+	def valueChanged(self, name, serviceName, path, changes):
+		self.dbusObjects[name]['value'] = changes['Value'] or 0
+		self.add(self.integrator.sample(time.monotonic(), **{name: self.dbusObjects[name]['value']}))
+
+	# Mettre à jour les valeurs dans l'array
+	def add(self, energy):
+		charged, discharged = energy
+		self.dbusObjects['charged']['value'] += charged
+		self.dbusObjects['discharged']['value'] += discharged
 
 	def update(self):
-		# Lire le temps systeme, calculer l'intervalle de temps par rapport à la mesure précédente et mettre à jour le temps de la dernière lecture
-		thisTime =	datetime.datetime.now()
-		interval = thisTime - self.previousTime
-		self.previousTime = thisTime
-		# Calculer l'énergie transférée dans l'intervalle en utilisant les valeurs de tension et de courant stockées
-		# Calcul en mWh en arrondissant les valeurs de tension et de courant à 2 digits
-		if (interval.total_seconds() > 0):
-			energy = (self.dbusObjects['voltage']['value'] * self.dbusObjects['current']['value'] * interval.total_seconds())/3600000
-		else:
-			energy = 0
-		# Mettre à jour les valeurs dans l'array
-		if (energy > 0): 
-			self.dbusObjects['charged']['value'] += energy
-		elif (energy < 0):
-			self.dbusObjects['discharged']['value'] -= energy
-
-		# Ecrire la valeur dans le bus
-		self.dbusObjects['charged']['proxy'].SetValue(wrap_dbus_value(self.dbusObjects['charged']['value']))
-		self.dbusObjects['discharged']['proxy'].SetValue(wrap_dbus_value(self.dbusObjects['discharged']['value']))
-		#Lire les nouvelles valeurs de voltage et current
-		self.dbusObjects['voltage']['value'] = unwrap_dbus_value(self.dbusObjects['voltage']['proxy'].GetValue())
-		self.dbusObjects['current']['value'] = unwrap_dbus_value(self.dbusObjects['current']['proxy'].GetValue())
-		"""
-		print (interval.total_seconds(), energy)
-		print ('charged', ' : ', self.dbusObjects['charged']['kWh'],
-			self.dbusObjects['charged']['Wh'], self.dbusObjects['charged']['mWh'], self.dbusObjects['charged']['value'])
-		print ('discharged', ' : ', self.dbusObjects['discharged']['kWh'],
-			self.dbusObjects['discharged']['Wh'], self.dbusObjects['discharged']['mWh'], self.dbusObjects['discharged']['value'])
-		"""
+		now = time.monotonic()
+		if now - self.integrator.time >= HOLD_INTERVAL:
+			self.add(self.integrator.hold(now))
+
+		if now - self.checkpointTime >= self.checkpointInterval:
+			try:
+				self.save()
+			except:
+				log.error('Exception in saving battery indexes', exc_info=True)
+
+		# Ecrire les valeurs dans le bus, au plus une fois par WRITE_INTERVAL
+		# sauf si elles ont varié de plus de WRITE_THRESHOLD
+		due = now - self.writeTime >= WRITE_INTERVAL
+		for name in ('charged', 'discharged'):
+			dbusObject = self.dbusObjects[name]
+			if dbusObject['written'] is None:
+				delta = WRITE_THRESHOLD
+			else:
+				delta = abs(dbusObject['value'] - dbusObject['written'])
+			if delta >= WRITE_THRESHOLD or (due and delta > 0):
+				dbusObject['proxy'].SetValue(wrap_dbus_value(dbusObject['value']))
+				dbusObject['written'] = dbusObject['value']
+				self.writeTime = now
 
 	def printAttributes(self):
 		for name, dbusObject in self.dbusObjects.items():
@@ -101,32 +233,90 @@ class BatteryMonitor(object):
 				print (name, ' : ', dbusObject['kWh'], dbusObject['Wh'], dbusObject['mWh'], dbusObject['value'])
 			else:
 				print (name, ' : ', dbusObject['value'])
-		print('Previous time : ', self.previousTime)
+		print('Previous time : ', self.integrator and self.integrator.time)
 	
+# Rejouer un enregistrement pour comparer l'énergie intégrée à une référence
+# Le fichier contient une ligne par mesure : temps (s), tension (V), courant (A),
+# énergie chargée (kWh) et énergie déchargée (kWh) de référence cumulées depuis le début
+# Seule une mesure sur step est utilisée, pour simuler un intervalle de lecture plus long
+# Retourne les énergies (chargée, déchargée) de référence, par trapèzes et par rectangles
+def replay(path, step=1):
+	samples = []
+	with open(path, 'r') as f:
+		for line in f:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			samples.append([float(x) for x in line.replace(';', ',').split(',')[:5]])
+
+	t0, v0, i0, c0, d0 = samples[0]
+	reference = (samples[-1][3] - c0, samples[-1][4] - d0)
+
+	trapezoid = EnergyIntegrator()
+	rectangle = EnergyIntegrator()
+	trap = [0, 0]
+	rect = [0, 0]
+	used = samples[::step]
+	if used[-1] is not samples[-1]:
+		used.append(samples[-1])
+	for t, v, i, c, d in used:
+		e = trapezoid.sample(t, v, i)
+		trap[0] += e[0]
+		trap[1] += e[1]
+		# méthode des rectangles : la puissance précédente est maintenue jusqu'à t
+		e = rectangle.hold(t)
+		rect[0] += e[0]
+		rect[1] += e[1]
+		rectangle.sample(t, v, i)
+
+	return reference, tuple(trap), tuple(rect)
+
 # Pour tester les fonctionalités en executant directement le fichier
+# Avec un fichier en argument (et éventuellement un pas), rejoue l'enregistrement
 if __name__ == '__main__':
+	import sys
+	if len(sys.argv) > 1:
+		step = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+		reference, trap, rect = replay(sys.argv[1], step)
+		for name, (c, d) in (('reference', reference), ('trapezoid', trap), ('rectangle', rect)):
+			print('%-10s charged %10.4f kWh  discharged %10.4f kWh' % (name, c, d))
+		for name, (c, d) in (('trapezoid', trap), ('rectangle', rect)):
+			print('%-10s error   %10.4f kWh             %10.4f kWh' % (name, c - reference[0], d - reference[1]))
+		sys.exit(0)
+
 	logging.basicConfig(
     filename='/data/home/root/venus.dbus-homedub/sunspec.log', 
     format='%(asctime)s: %(levelname)-8s %(message)s', 
     datefmt="%Y-%m-%d %H:%M:%S", 
     level=logging.INFO)
 
+	from gi.repository import GLib
+	import dbus.mainloop.glib
+	dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+	mainloop = GLib.MainLoop()
+
 	dbusConn = private_bus()
 	batmon = BatteryMonitor (dbusConn)
 	batmon.printAttributes()
 	batmon.init()
 	batmon.printAttributes()
-	
-	i = 0
-	while i < 1000:
-		i = i +1
-		time.sleep(0.25)
+
+	# les changements de tension et de courant n'arrivent que si la boucle GLib tourne
+	ticks = [0]
+	def tick():
+		ticks[0] += 1
 		batmon.update()
 		if os.path.isfile('/data/home/root/venus.dbus-homedub/kill'):
 			batmon.save()
 			print('Program interrupted on purpose')
 			os.remove('kill')
 			os._exit(1)
+		if ticks[0] < 1000:
+			return True
+		mainloop.quit()
+		return False
+
+	GLib.timeout_add(250, tick)
+	mainloop.run()
 
 	batmon.printAttributes()
-		
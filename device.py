@@ -1,4 +1,3 @@
-from copy import copy
 import dbus
 from functools import partial
 from pymodbus.client.sync import *
@@ -12,13 +11,15 @@ from settingsdevice import SettingsDevice
 from vedbus import VeDbusService
 
 import __main__
-from register import Reg
+from register import Reg, RegBlock
 from utils import *
 
 log = logging.getLogger()
 
 class ModbusDevice(object):
     min_timeout = 0.1
+    service_class = VeDbusService
+    signal_text = True
 
     def __init__(self, modbus, unit, model):
         self.modbus = modbus.get()
@@ -31,6 +32,7 @@ class ModbusDevice(object):
         self.err_count = 0
         self.latency = modbus.timeout
         self.need_reinit = False
+        self.connected = True
 
     def destroy(self):
         log.debug('Detroying device %s', self.model)
@@ -106,34 +108,31 @@ class ModbusDevice(object):
             self.read_register(reg)
             d[reg.name] = reg
 
-    def read_data_regs(self, regs, d):
-        now = time.time()
-
-        if all(now - r.time < r.max_age for r in regs):
-            return
-
-        start = regs[0].base
-        count = regs[-1].base + regs[-1].count - start
-
+    def read_data_block(self, start, count):
         rr = self.modbus.read_holding_registers(start, count, unit=self.unit)
 
-        latency = time.time() - now
-
         if not isinstance(rr, ReadHoldingRegistersResponse):
             log.debug('Error reading registers %#04x-%#04x: %s',
                       start, start + count - 1, rr)
             raise Exception(rr)
 
-        for reg in regs:
-            base = reg.base - start
-            end = base + reg.count
+        return rr.registers
+
+    def read_data_regs(self, regs, now):
+        if all(now - r.time < r.max_age for r in regs):
+            return None
+
+        values = self.read_data_block(regs.start, regs.count)
+
+        return regs, values, time.time() - now
 
+    def decode_data_regs(self, regs, values, now, d):
+        for reg, raw in regs.decode(values):
             if now - reg.time > reg.max_age:
-                if reg.decode(rr.registers[base:end]):
-                    d[reg.name] = copy(reg) if reg.isvalid() else None
+                reg.schedule(reg.set_raw_value(raw))
                 reg.time = now
-
-        return latency
+                if reg.publish(now):
+                    d[reg.name] = reg.value
 
     def read_info(self):
         if not self.info:
@@ -146,16 +145,20 @@ class ModbusDevice(object):
         self.settings_dbus = dbus
 
         path = '/Settings/Devices/' + self.get_ident()
-        role = self.role or self.default_role
+        SETTINGS = self.device_settings(path)
+
+        self.settings = SettingsDevice(dbus, SETTINGS, self.setting_changed)
+        self.role, self.devinst = self.get_role_instance()
+
+    def device_settings(self, path):
+        # all settings of a device are added in one go, subclasses
+        # extend this dict rather than adding settings of their own
         def_inst = '%s:%s' % (self.default_role, self.default_instance)
 
-        SETTINGS = {
+        return {
             'instance':   [path + '/ClassAndVrmInstance', def_inst, 0, 0],
         }
 
-        self.settings = SettingsDevice(dbus, SETTINGS, self.setting_changed)
-        self.role, self.devinst = self.get_role_instance()
-
     def setting_changed(self, name, old, new):
         if name == 'instance':
             role, inst = self.get_role_instance()
@@ -216,13 +219,18 @@ class ModbusDevice(object):
 
         return False
 
-    def dbus_add_register(self, r):
-        v = r if r.isvalid() else None
+    def dbus_get_text(self, reg, path, val):
+        return reg.get_text(val)
+
+    def dbus_register_path(self, r):
+        # registers are exported as plain values, the text is
+        # formatted by the register only when it is requested
+        tcb = partial(self.dbus_get_text, r)
         if r.write:
             cb = partial(self.dbus_write_register, r)
-            self.dbus.add_path(r.name, v, writeable=True, onchangecallback=cb)
-        else:
-            self.dbus.add_path(r.name, v)
+            return r.name, r.value, dict(writeable=True, onchangecallback=cb,
+                                         gettextcallback=tcb)
+        return r.name, r.value, dict(gettextcallback=tcb)
 
     def pack_regs(self, regs):
         rr = []
@@ -253,42 +261,56 @@ class ModbusDevice(object):
 
         return regs
 
+    def compile_data_regs(self):
+        return [RegBlock(r) for r in self.pack_regs(self.data_regs)]
+
     def init(self, dbus):
         self.device_init()
         self.read_info()
         self.init_device_settings(dbus)
 
-        self.data_regs = self.pack_regs(self.data_regs)
+        self.data_regs = self.compile_data_regs()
         ident = self.get_ident()
 
         svcname = 'com.victronenergy.%s.%s' % (self.role, ident)
-        self.dbus = VeDbusService(svcname, private_bus())
+        self.dbus = self.service_class(svcname, private_bus(),
+                                       signaltext=self.signal_text)
+
+        # all paths are registered in one go
+        self.dbus.add_paths(self.dbus_paths())
+        self.connected = True
+
+        self.latfilt = LatencyFilter(self.latency)
+        self.device_init_late()
 
-        self.dbus.add_path('/Mgmt/ProcessName', __main__.NAME)
-        self.dbus.add_path('/Mgmt/ProcessVersion', __main__.VERSION)
-        self.dbus.add_path('/Mgmt/Connection', self.connection())
-        self.dbus.add_path('/DeviceInstance', self.devinst)
-        self.dbus.add_path('/ProductId', self.productid)
-        self.dbus.add_path('/ProductName', self.productname)
-        self.dbus.add_path('/Model', self.model)
-        self.dbus.add_path('/Connected', 1)
+    def dbus_paths(self):
+        paths = [
+            ('/Mgmt/ProcessName', __main__.NAME),
+            ('/Mgmt/ProcessVersion', __main__.VERSION),
+            ('/Mgmt/Connection', self.connection()),
+            ('/DeviceInstance', self.devinst),
+            ('/ProductId', self.productid),
+            ('/ProductName', self.productname),
+            ('/Model', self.model),
+            ('/Connected', 1),
+        ]
 
         if self.allowed_roles:
-            self.dbus.add_path('/AllowedRoles', self.allowed_roles)
-            self.dbus.add_path('/Role', self.role, writeable=True,
-                               onchangecallback=self.role_changed)
+            paths.append(('/AllowedRoles', self.allowed_roles))
+            paths.append(('/Role', self.role,
+                          dict(writeable=True,
+                               onchangecallback=self.role_changed)))
         else:
-            self.dbus.add_path('/Role', self.role)
+            paths.append(('/Role', self.role))
 
         for p in self.info:
-            self.dbus_add_register(self.info[p])
+            paths.append(self.dbus_register_path(self.info[p]))
 
         for r in self.data_regs:
             for rr in r:
-                self.dbus_add_register(rr)
+                paths.append(self.dbus_register_path(rr))
 
-        self.latfilt = LatencyFilter(self.latency)
-        self.device_init_late()
+        return paths
 
     def device_init(self):
         pass
@@ -296,22 +318,64 @@ class ModbusDevice(object):
     def device_init_late(self):
         pass
 
-    def update(self):
+    def check_reinit(self):
         if self.need_reinit:
             self.reinit()
 
+    def poll(self):
+        # Called from a worker thread, only performs the Modbus
+        # transactions.  The results are decoded and published on
+        # D-Bus by publish() from the main loop.
+        now = time.time()
+        blocks = []
+
+        for r in self.data_regs:
+            b = self.read_data_regs(r, now)
+            if b:
+                blocks.append(b)
+
+        return now, blocks
+
+    def disconnect(self):
+        # The device stopped answering: invalidate its values but keep
+        # the D-Bus service and the registers so that it can resume
+        # cheaply once it answers again.
+        self.connected = False
+
+        with self.dbus as d:
+            d['/Connected'] = 0
+            for regs in self.data_regs:
+                for reg in regs:
+                    reg.value = None
+                    reg.time = 0
+                    reg.max_age = reg.min_age
+                    reg.unpublish()
+                    d[reg.name] = None
+
+    def reconnect(self):
+        self.connected = True
+        self.dbus['/Connected'] = 1
+
+    def publish(self, data):
+        now, blocks = data
         latency = []
 
+        if not self.connected:
+            self.reconnect()
+
         with self.dbus as d:
-            for r in self.data_regs:
-                t = self.read_data_regs(r, d)
-                if t:
-                    latency.append(t)
+            for regs, values, t in blocks:
+                self.decode_data_regs(regs, values, now, d)
+                latency.append(t)
 
         if latency:
             self.latency = self.latfilt.filter(latency)
             self.modbus.timeout = max(self.min_timeout, self.latency * 4)
 
+    def update(self):
+        self.check_reinit()
+        self.publish(self.poll())
+
 class LatencyFilter(object):
     def __init__(self, val):
         self.length = 8
@@ -338,43 +402,45 @@ class EnergyMeter(ModbusDevice):
     default_role = 'grid'
     default_instance = 40
 
-    def customname_setting_changed(self, service, path, value):
-        self.dbus['/CustomName'] = value['Value']
+    def device_settings(self, path):
+        settings = super(EnergyMeter, self).device_settings(path)
+        settings['customname'] = [path + '/CustomName', '', 0, 0]
 
-    def position_setting_changed(self, service, path, value):
-        self.dbus['/Position'] = value['Value']
+        # the role is only known once the settings are read, /Position
+        # is published for PV inverters only
+        settings['position'] = [path + '/Position', 0, 0, 2]
 
-    def init_device_settings(self, dbus):
-        super(EnergyMeter, self).init_device_settings(dbus)
-        path = '/Settings/Devices/' + self.get_ident()
-        self.cn_item = self.settings.addSetting(path + '/CustomName', '', 0, 0,
-            callback=self.customname_setting_changed)
+        return settings
 
-        self.pos_item = None
-        if self.role == 'pvinverter':
-            self.pos_item = self.settings.addSetting(path + '/Position', 0, 0, 2,
-                callback=self.position_setting_changed)
+    def setting_changed(self, name, old, new):
+        if name == 'customname':
+            self.dbus['/CustomName'] = new
+            return
 
-    def init(self, dbus):
-        super(EnergyMeter, self).init(dbus)
+        super(EnergyMeter, self).setting_changed(name, old, new)
 
-        self.dbus.add_path('/CustomName', self.cn_item.get_value(),
-                           writeable=True,
-                           onchangecallback=self.customname_changed)
+    def dbus_paths(self):
+        paths = super(EnergyMeter, self).dbus_paths()
+
+        paths.append(('/CustomName', self.settings['customname'],
+                      dict(writeable=True,
+                           onchangecallback=self.customname_changed)))
+
+        if self.role == 'pvinverter':
+            paths.append(('/Position', self.settings['position'],
+                          dict(writeable=True,
+                               onchangecallback=self.position_changed)))
 
-        if self.pos_item is not None:
-            self.dbus.add_path('/Position', self.pos_item.get_value(),
-                               writeable=True,
-                               onchangecallback=self.position_changed)
+        return paths
 
     def customname_changed(self, path, val):
-        self.cn_item.set_value(val)
+        self.settings['customname'] = val
         return True
 
     def position_changed(self, path, val):
         if not 0 <= val <= 2:
             return False
-        self.pos_item.set_value(val)
+        self.settings['position'] = val
         return True
 
 __all__ = [
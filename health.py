@@ -0,0 +1,71 @@
+import random
+
+HEALTHY = 0
+DEGRADED = 1
+OPEN = 2
+HALF_OPEN = 3
+
+STATE_TEXT = {
+    HEALTHY:    'Healthy',
+    DEGRADED:   'Degraded',
+    OPEN:       'Open circuit',
+    HALF_OPEN:  'Half-open',
+}
+
+class EndpointHealth(object):
+    '''Circuit breaker tracking the health of a Modbus endpoint
+
+    A healthy endpoint becomes degraded on its first error and returns
+    to healthy on the next success.  After `max_errors` consecutive
+    errors, or on a failure which trips it at once, the circuit opens:
+    no request is allowed until the backoff delay has elapsed.  A
+    single trial is then allowed (half-open).  A successful trial
+    closes the circuit, a failed one reopens it with twice the delay,
+    up to `max_backoff`.
+    Delays are randomised by +/- `jitter` so that endpoints failing
+    together are not retried together.
+
+    '''
+
+    def __init__(self, max_errors, min_backoff, max_backoff, jitter=0.2):
+        self.max_errors = max_errors
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.state = HEALTHY
+        self.errors = 0
+        self.backoff = min_backoff
+        self.retry_time = 0
+
+    def __str__(self):
+        return STATE_TEXT[self.state]
+
+    def allow(self, now):
+        if self.state == OPEN:
+            if now < self.retry_time:
+                return False
+            self.state = HALF_OPEN
+        return True
+
+    def success(self):
+        self.state = HEALTHY
+        self.errors = 0
+        self.backoff = self.min_backoff
+
+    def failure(self, now, trip=False):
+        self.errors += 1
+
+        if trip or self.state == HALF_OPEN or self.errors >= self.max_errors:
+            self.trip(now)
+        else:
+            self.state = DEGRADED
+
+    def trip(self, now):
+        if self.state == HALF_OPEN:
+            self.backoff = min(2 * self.backoff, self.max_backoff)
+        else:
+            self.backoff = self.min_backoff
+
+        j = random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.retry_time = now + self.backoff * j
+        self.state = OPEN
@@ -7,11 +7,10 @@
 # the file sunspec is imported instead of other meter files normally imported by dbus-modbus-client
 # it includes:
 #   1 class named SunspecHub which can contain several devices having the same modbus address
-#   1 class named SunspecInverter which addresses the block of registers corresponding to PV inverter data
-#   1 class named SunspecMeter which addresses the block of registers corresponding to grid meter data
-#   Both classes inherit from a class named SunspecDevice which contains a read_data_register method
+#   1 class named SunspecModelDevice created for each model found in the Sunspec model chain
+#   (PV inverters, meters, batteries), described declaratively in sunspecmodels
+#   It inherits from a class named SunspecDevice which contains a read_data_register method
 #   Which allows to read the scale factors in the modbus table as defined in the Sunspec Protocol
-# Classes are 100% identical
 
 # Revision 16/03/2023
 # Added a battery monitor to record the cumulated energy loaded in the battery and pulled from the battery
@@ -22,9 +21,15 @@
 # This function calls a method of the batteryMonitor to save the charge and discharde indexes
 # and exit the glibloop
 
+# Revision 16/10/2026
+# The 'kill' file is watched with inotify instead of being checked on every update
+# SIGTERM stops the program the same way
+
 # get access to packages of dbus-modbus-client
 import sys
 import os
+import re
+from functools import partial
 #sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-modbus-client'))
 
 from argparse import ArgumentParser
@@ -37,12 +42,15 @@ from settingsdevice import SettingsDevice
 import signal
 import time
 import traceback
-from vedbus import VeDbusService
-from gi.repository import GLib
+from vedbus import VeDbusService, VeDbusVirtualService
+from gi.repository import GLib, Gio
 
 import device
+import health
 #import mdns
 import probe
+from poller import Poller
+from probecache import ProbeCache
 #from scan import *
 from utils import *
 import watchdog
@@ -65,10 +73,14 @@ pymodbus.constants.Defaults.Timeout = 0.5
 
 MAX_ERRORS = 5 # was 5 in initial file
 FAILED_INTERVAL = 10
+MAX_BACKOFF = 600
 #MDNS_CHECK_INTERVAL = 5
 #MDNS_QUERY_INTERVAL = 60
 #SCAN_INTERVAL = 600
 UPDATE_INTERVAL = 250
+KILL_FILE = '/data/home/root/venus.dbus-homedub/kill'
+PROBE_CACHE = '/data/home/root/venus.dbus-homedub/probe_cache.json'
+POLL_WORKERS = 8
 
 if_blacklist = [
     'ap0',
@@ -83,12 +95,15 @@ time.tzset()
 def percent(path, val):
     return '%d%%' % val
 """
+def health_text(path, val):
+    return health.STATE_TEXT.get(val, '---')
+
 class Client(object):
     def __init__(self, name):
         self.name = name
         self.devices = []
         self.failed = []
-        self.failed_time = 0
+        self.health = {}
         self.scanner = None
         self.scan_time = time.time()
         self.auto_scan = False
@@ -98,6 +113,9 @@ class Client(object):
         self.watchdog = watchdog.Watchdog()
         self.keep_frozen = False
         self.battery_monitor = None
+        self.kill_monitor = None
+        self.poller = Poller(POLL_WORKERS)
+        self.probe_cache = ProbeCache(PROBE_CACHE)
     """
     def start_scan(self, full=False):
         if self.scanner:
@@ -157,88 +175,208 @@ class Client(object):
             self.battery_monitor.save()
         except:
             log.error('Exception in saving battery_monitor', exc_info=True)
-        os.remove('/data/home/root/venus.dbus-homedub/kill')
+        if os.path.isfile(KILL_FILE):
+            os.remove(KILL_FILE)
         os._exit(1)
 
+    def watch_kill_file(self):
+        # the directory holding the kill file is watched with inotify
+        # through a Gio file monitor, so the main loop is only woken up
+        # when something changes in it
+        d = Gio.File.new_for_path(os.path.dirname(KILL_FILE))
+        self.kill_monitor = d.monitor_directory(Gio.FileMonitorFlags.NONE,
+                                                None)
+        self.kill_monitor.connect('changed', self.kill_file_changed)
+
+        # SIGTERM gets the same treatment as the kill file
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM,
+                             self.exit_program)
+
+        if os.path.isfile(KILL_FILE):
+            GLib.idle_add(self.exit_program)
+
+    def kill_file_changed(self, monitor, f, other, event):
+        if f.get_path() != KILL_FILE:
+            return
+
+        if event in (Gio.FileMonitorEvent.CREATED,
+                     Gio.FileMonitorEvent.CHANGES_DONE_HINT):
+            self.exit_program()
+
     def update_device(self, dev):
+        # The Modbus transactions run on a worker thread so that a slow
+        # or unreachable device does not stall the others.  Decoding and
+        # publishing on D-Bus happen in device_polled, on the main loop.
+        if dev in self.poller:
+            return
+
+        if not self.get_health(dev).allow(time.time()):
+            return
+
+        try:
+            dev.check_reinit()
+        except:
+            self.device_failed(dev)
+            return
+
+        self.poller.submit(dev, dev.poll, partial(self.device_polled, dev))
+
+    def device_polled(self, dev, data, exc):
+        # the device may have been destroyed, and possibly replaced by
+        # a new instance for the same endpoint, while being polled
+        if not any(d is dev for d in self.devices):
+            return
+
         try:
+            if exc:
+                raise exc
             # Normally there is no update method in the class of the Device
             # So the method update of the parent (EnergyMeter) is called
             # We create an update method in the class SunspecDevice to allow
             # management of multiple devices
-            dev.update()
-            dev.err_count = 0
-
+            dev.publish(data)
+            self.device_succeeded(dev)
         except:
-            dev.err_count += 1
-            if dev.err_count == MAX_ERRORS:
-                log.debug('Error in executing update_devices')
-                log.debug('List of devices before error %s', self.devices)
-                log.debug('Device %s failed', dev)
-                if self.err_exit:
-                    os._exit(1)
-                log.debug('List of failed before error %s', self.failed)
-                if not dev.nosave:
-                    self.failed.append(str(dev))
-                log.debug('List of failed after error %s', self.failed)
-                if dev.sunspec_devices:
-                    log.debug('List of sunspec_devices before error %s', dev.sunspec_devices)
-                    for sd in dev.sunspec_devices:
-                        log.debug('Deleting Sunspec_device %s at %s', sd.model, sd)
-                        sd.destroy()
-                    dev.sunspec_devices.clear()
-                    log.debug('List of sunspec_devices after error %s', dev.sunspec_devices)
-                self.devices.remove(dev)
-                log.debug('List of devices after error %s', self.devices)
-                dev.destroy()
+            self.device_failed(dev)
+
+    def get_health(self, m):
+        m = str(m)
+        if m not in self.health:
+            self.health[m] = health.EndpointHealth(MAX_ERRORS, FAILED_INTERVAL,
+                                                   MAX_BACKOFF)
+        return self.health[m]
+
+    def health_path(self, m):
+        return '/Endpoints/' + re.sub('[^A-Za-z0-9_]', '_', str(m))
+
+    def add_health(self, m):
+        # publish the state of the endpoint on the management service,
+        # from its first probe on
+        if not self.svc:
+            return
+
+        h = self.get_health(m)
+        path = self.health_path(m)
+
+        if path + '/State' not in self.svc:
+            self.svc.add_path(path + '/Endpoint', str(m))
+            self.svc.add_path(path + '/State', h.state,
+                              gettextcallback=health_text)
+            self.svc.add_path(path + '/Errors', h.errors)
+
+    def health_changed(self, m):
+        if not self.svc:
+            return
+
+        self.add_health(m)
+
+        h = self.get_health(m)
+        path = self.health_path(m)
+        self.svc[path + '/State'] = h.state
+        self.svc[path + '/Errors'] = h.errors
+
+    def remove_health(self, m):
+        self.health.pop(m, None)
+
+        if not self.svc:
+            return
+
+        path = self.health_path(m)
+        for p in ['/Endpoint', '/State', '/Errors']:
+            if path + p in self.svc:
+                del self.svc[path + p]
+
+    def device_succeeded(self, dev):
+        h = self.get_health(dev)
+        if h.state != health.HEALTHY:
+            h.success()
+            self.health_changed(dev)
+
+    def device_failed(self, dev, trip=False):
+        h = self.get_health(dev)
+        h.failure(time.time(), trip)
+        self.health_changed(dev)
+
+        # A device which stops answering is not destroyed: it is kept
+        # in a disconnected state, with its D-Bus service, until its
+        # circuit breaker allows a new trial which succeeds
+        if h.state == health.OPEN and dev in self.devices and dev.connected:
+            log.debug('Device %s failed, disconnecting', dev)
+            if self.err_exit:
+                os._exit(1)
+            try:
+                dev.disconnect()
+            except:
+                log.debug('Exception in disconnecting %s', dev, exc_info=True)
 
     def probe_devices(self, devlist, nosave=False):
         # devlist: list of devices to probe
         # each item like [method, ip, port, unit]
-        #print(os.path.abspath(__file__), '>Entering Client.probe_devices')
         # only probe devices that have not been probed yet
-        devs = set(devlist) - set(self.devices)
+        devs = set(filter(None, devlist)) - set(self.devices)
         log.debug('Devices to probe %s', devs)
-        #print ('devs: ', devs)
-        # probe if the device can be contacted and correspond to a known type of device
-        # devs = list of recognized devices, 
+        # Each device is probed on a worker thread so that an endpoint
+        # which does not answer does not block the main loop.
+        # Until its probe completes, a device is kept in self.failed
+        # so that it stays in the saved list of devices.
+        # Devices found by a previous run are created from the probe
+        # cache, which saves most of the identification reads.
+        for m in devs:
+            if m not in self.failed:
+                self.failed.append(m)
+            self.add_health(m)
+            entry = self.probe_cache.get(m)
+            if entry:
+                func = partial(probe.probe_cached, m, entry)
+            else:
+                func = partial(probe.probe, [m])
+            self.poller.submit(('probe', m), func,
+                               partial(self.device_probed, m, nosave))
+
+    def device_probed(self, m, nosave, result, exc):
+        # called on the main loop when the probe of device m completes
+        # result is the tuple (devs, failed) returned by probe.probe
+        # devs = list of recognized devices,
         # each entry is an instance of the class corresponding to the type of device found
-        #   if a device is found a log is made in debug mode
-        # failed = list of non recognized devices, each item like [method, ip, port, unit]
-        devs, failed = probe.probe(devs)
+        # the device has been removed from the list while being probed
+        if m not in self.failed:
+            for d in (result[0] if result else []):
+                d.destroy()
+            return
+
+        if exc:
+            log.debug('Exception in probing %s', m, exc_info=exc)
+            self.device_failed(m, trip=True)
+            return
+
+        devs, failed = result
         log.debug('Probed devices: devs %s | failed %s', devs, failed)
-        #print ('devs: ', devs, 'failed: ', failed)
-        # initialize all devices that have been found
+
+        # initialize the device if it has been found
         for d in devs:
             try:
                 # Normally there is no init method in the class of the Device
                 # So the method init of the parent (EnergyMeter) is called
                 # We create an init method in the class SunspecDevice to allow
                 # management of multiple devices
-                #print(os.path.abspath(__file__), '>In Client.probe_devices, self.dbusconn', self.dbusconn)0
                 log.debug('List of sunspec_devices %s', d.sunspec_devices)
                 d.init(self.dbusconn)
-                #print(os.path.abspath(__file__), '>In Client.probe_devices, d.init completed')
                 d.nosave = nosave
-                #print(os.path.abspath(__file__), '>In Client.probe_devices, d.nosave set')
                 self.devices.append(d)
-                #print(os.path.abspath(__file__), '>In Client.probe_devices, d ajouté à self.devices')
+                self.failed.remove(m)
+                self.device_succeeded(m)
+                if hasattr(d, 'cache_entry'):
+                    self.probe_cache.set(m, d.cache_entry())
                 log.debug('List of devices %s', self.devices)
                 if d.sunspec_devices:
                     log.debug('List of sunspec_devices %s', d.sunspec_devices)
                     for sd in d.sunspec_devices:
                         log.debug('Sunspec_device %s active at %s', sd.model, sd)
-                #raise TypeError
             except:
-                #traceback.print_exc() #rajouté pour débugger
                 log.debug('Error in executing probe_devices')
-                log.debug('List of devices before error %s', self.devices)
                 log.debug('Device %s failed', d)
                 if self.err_exit:
                     os._exit(1)
-                log.debug('List of failed before error %s', failed)
-                failed.append(str(d))
-                log.debug('List of failed after error %s', failed)
                 if d.sunspec_devices:
                     log.debug('List of sunspec_devices before error %s', d.sunspec_devices)
                     for sd in d.sunspec_devices:
@@ -246,13 +384,19 @@ class Client(object):
                         sd.destroy()
                     d.sunspec_devices.clear()
                     log.debug('List of sunspec_devices after error %s', d.sunspec_devices)
-                self.devices.remove(d)
-                log.debug('List of devices after error %s', self.devices)
+                if d in self.devices:
+                    self.devices.remove(d)
                 d.destroy()
                 log.debug('Treatment of error completed successfully, waiting ...')
-        #print(os.path.abspath(__file__), '>In Client.probe_devices')
-        #print(os.path.abspath(__file__), 'self.devices, failed: ', self.devices, failed)
-        return failed
+
+        # entries which are not valid device descriptions are dropped
+        if not devs and not failed:
+            self.failed.remove(m)
+            self.remove_health(m)
+        elif m in self.failed:
+            self.device_failed(m, trip=True)
+
+        self.save_devices()
 
     def save_devices(self):
         devs = filter(lambda d: not d.nosave, self.devices)
@@ -272,11 +416,15 @@ class Client(object):
         for d in rem & cur:
             dd = self.devices.pop(self.devices.index(d))
             dd.destroy()
+        for d in rem:
+            self.remove_health(d)
+            self.probe_cache.remove(d)
+        self.failed = [d for d in self.failed if d in new]
         # probe all new devices and save them
         # for devices that are successfully probed, 
         #   the instance of the probed device class is added to self.devices
-        # devices that are not probed are returned in the self.failed
-        self.failed = self.probe_devices(new);
+        # devices that are not probed remain in self.failed
+        self.probe_devices(new)
         self.save_devices()
 
     def setting_changed(self, name, old, new):
@@ -293,6 +441,14 @@ class Client(object):
         }
 
         self.dbusconn = private_bus()
+
+        # management service exposing the state of the endpoints
+        try:
+            svcname = 'com.victronenergy.homedub.%s' % self.name
+            self.svc = VeDbusService(svcname, self.dbusconn)
+        except:
+            log.info('Exception in creating management service', exc_info=True)
+
         log.debug('Waiting for localsettings')
         #Check if path exist and retrieve all devices shown under path /Devices
         self.settings = SettingsDevice(self.dbusconn, SETTINGS,
@@ -320,6 +476,7 @@ class Client(object):
         except:
             log.info('Exception in creating battery_monitor', exc_info=True)
 
+        self.watch_kill_file()
         self.watchdog.start()
         log.info('Initialisation completed')
         
@@ -339,15 +496,17 @@ class Client(object):
                 if self.svc:
                     self.svc['/ScanProgress'] = None
         """
-        for d in self.devices:
+        for d in list(self.devices):
             self.update_device(d)
         
         if self.failed:
             now = time.time()
 
-            if now - self.failed_time > FAILED_INTERVAL:
-                self.failed = self.probe_devices(self.failed)
-                self.failed_time = now
+            # failed devices are only probed again when their
+            # circuit breaker allows a new trial
+            retry = [m for m in self.failed if self.get_health(m).allow(now)]
+            if retry:
+                self.probe_devices(retry)
             """
             if self.settings['autoscan']:
                 if now - self.scan_time > SCAN_INTERVAL:
@@ -366,11 +525,6 @@ class Client(object):
         except:
             log.error('Uncaught exception in update', exc_info=True)
             #traceback.print_exc()
-        
-        # to stop the program when needed
-        # if a file named 'kill' exists in the directory
-        if os.path.isfile('/data/home/root/venus.dbus-homedub/kill'):
-            self.exit_program()
         return True
 
 class NetClient(Client):
@@ -425,6 +579,10 @@ def main():
     parser.add_argument('-f', '--force-scan', action='store_true')
     parser.add_argument('-x', '--exit', action='store_true',
                         help='exit on error')
+    parser.add_argument('-t', '--virtual-tree', action='store_true',
+                        help='serve the D-Bus paths of each device from a single object')
+    parser.add_argument('--no-signal-text', action='store_true',
+                        help='leave the text out of D-Bus change signals')
 
     args = parser.parse_args()
     
@@ -453,6 +611,12 @@ def main():
 
     client.err_exit = args.exit
 
+    if args.virtual_tree:
+        device.ModbusDevice.service_class = VeDbusVirtualService
+
+    if args.no_signal_text:
+        device.ModbusDevice.signal_text = False
+
     #print(os.path.abspath(__file__), '>calling client.init')
     client.init(args.force_scan)
     #print(os.path.abspath(__file__), '>client.init completed')
@@ -0,0 +1,52 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import GLib
+
+log = logging.getLogger()
+
+class Poller(object):
+    '''Run blocking Modbus transactions on worker threads
+
+    Jobs are submitted from the GLib main loop with a key identifying
+    the device or endpoint they belong to.  At most one job per key is
+    in flight at any time.  When a job completes, its callback is
+    invoked on the main loop as `callback(result, exc)` where `exc` is
+    the exception raised by the job, if any.
+
+    '''
+
+    def __init__(self, workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def submit(self, key, func, callback):
+        if key in self.pending:
+            return False
+
+        fut = self.executor.submit(func)
+        self.pending[key] = fut
+        fut.add_done_callback(
+            lambda f: GLib.idle_add(self.complete, key, f, callback))
+        return True
+
+    def complete(self, key, fut, callback):
+        if self.pending.get(key) is fut:
+            del self.pending[key]
+
+        exc = fut.exception()
+        result = None if exc else fut.result()
+
+        try:
+            callback(result, exc)
+        except:
+            log.error('Uncaught exception in poll callback', exc_info=True)
+
+        return False
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.pending.clear()
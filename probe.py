@@ -1,3 +1,4 @@
+from copy import copy
 import logging
 import os
 import struct
@@ -148,9 +149,12 @@ def probe(mlist, pr_cb=None, pr_interval=10, timeout=None):
                 break
 
             if d:
-                log.debug('Found %s at %s', d.model, d)
                 d.method = m[0]
                 d.latency = t1 - t0
+                if not discover(d, timeout):
+                    d = None
+                    break
+                log.debug('Found %s at %s', d.model, d)
                 found.append(d)
                 break
 
@@ -170,6 +174,68 @@ def probe(mlist, pr_cb=None, pr_interval=10, timeout=None):
 
     return found, failed
 
+def discover(d, timeout=None):
+    # A device holding other devices, such as a Sunspec model map, finds
+    # them with its discover method here, on the probing thread, so that
+    # its init on the main loop has no Modbus traffic left to do.
+    if not hasattr(d, 'discover'):
+        return True
+
+    try:
+        with utils.timeout(d.modbus, timeout or 1):
+            d.discover()
+        return True
+    except:
+        log.debug('Discovery of devices at %s failed', d, exc_info=True)
+        d.destroy()
+        return False
+
+def get_handler(marker):
+    for t in device_types:
+        models = getattr(t, 'models', {})
+        if marker in models:
+            return models[marker]
+    return None
+
+def probe_cached(m, entry, timeout=None):
+    # Create the device at m from the entry saved in the probe cache
+    # after a previous probe, without reading its model register.  The
+    # device confirms the entry with its load_cache method; when that
+    # fails, m is probed as usual.
+    mm = m.split(':')
+    modbus = None
+    d = None
+
+    try:
+        modbus = make_modbus(mm)
+        h = get_handler(entry['marker'])
+
+        if modbus and h:
+            t0 = time.time()
+            d = h['handler'](modbus, int(mm[-1]), h['model'])
+            d.method = mm[0]
+
+            with utils.timeout(modbus, timeout or 1):
+                if d.load_cache(entry):
+                    d.latency = time.time() - t0
+                else:
+                    d.destroy()
+                    d = None
+    except:
+        log.debug('Cached probe of %s failed', m, exc_info=True)
+        if d:
+            d.destroy()
+            d = None
+    finally:
+        if modbus:
+            modbus.put()
+
+    if d:
+        log.debug('Found %s at %s from cache', d.model, d)
+        return [d], []
+
+    return probe([m], timeout=timeout)
+
 def add_handler(devtype):
     if devtype not in device_types:
         device_types.append(devtype)
@@ -199,10 +265,14 @@ class ModelRegister(object):
         self.rates = args.get('rates', [])
 
     def probe(self, modbus, unit, timeout=None):
+        # probes may run concurrently on worker threads, each decodes
+        # into its own copy of the register
+        reg = copy(self.reg)
+
         with modbus, utils.timeout(modbus, timeout or self.timeout):
             if not modbus.connect():
                 raise Exception('connection error')
-            rr = modbus.read_holding_registers(self.reg.base, self.reg.count,
+            rr = modbus.read_holding_registers(reg.base, reg.count,
                 unit=unit)
         """
         if not isinstance(rr, ReadHoldingRegistersResponse):
@@ -213,7 +283,7 @@ class ModelRegister(object):
             log.error('Error reading register %#04x: %s', reg.base, rr)
             raise Exception(rr)
 
-        self.reg.decode(rr.registers)
-        if self.reg.value in self.models:
-            m = self.models[self.reg.value]
+        reg.decode(rr.registers)
+        if reg.value in self.models:
+            m = self.models[reg.value]
             return m['handler'](modbus, unit, m['model'])
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+
+log = logging.getLogger()
+
+class ProbeCache(object):
+    '''Identification of the devices found at each endpoint
+
+    Entries are saved by endpoint ('tcp:host:port:unit') as returned
+    by the `cache_entry` method of a device after a successful probe.
+    At startup, probe.probe_cached() uses them to create the device
+    without probing, the device confirming the entry with a few
+    register reads.  The file is rewritten atomically, and only when
+    an entry has actually changed.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            log.warning('Discarding probe cache %s', path, exc_info=True)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.save()
+
+    def remove(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+        except OSError:
+            log.warning('Cannot save probe cache %s', self.path, exc_info=True)
@@ -1,10 +1,11 @@
 import dbus
 import logging
-import time
 from functools import partial
+from gi.repository import GLib
 
 # Local imports
-from vedbus import VeDbusItemImport
+from vedbus import VeDbusItemImport, VeDbusRootTracker
+from ve_utils import wrap_dbus_value, unwrap_dbus_value
 
 ## Indexes for the setting dictonary.
 PATH = 0
@@ -13,6 +14,159 @@ MINIMUM = 2
 MAXIMUM = 3
 SILENT = 4
 
+# Presence of the settings services, by D-Bus name. Shared by all the SettingsDevice instances
+# of the process: the owner of a name is asked for once, and then followed with NameOwnerChanged.
+_service_present = {}
+_service_watches = {}
+_service_waiters = []
+
+def _service_owner_changed(name, owner):
+	_service_present[name] = bool(owner)
+	if owner:
+		for loop in _service_waiters:
+			loop.quit()
+		cache = _settings_caches.get(name)
+		if cache is not None:
+			try:
+				cache.load()
+			except dbus.exceptions.DBusException:
+				logging.debug('Reloading the settings of %s failed' % name, exc_info=True)
+
+## Wait for a D-Bus service to be present
+# Returns at once when the service is known to be present. Otherwise runs a nested main loop
+# until the service appears or the timeout (in seconds) expires.
+# @return True if the service is present
+def wait_for_service(bus, name, timeout=0):
+	if name not in _service_watches:
+		_service_present[name] = bool(bus.name_has_owner(name))
+		_service_watches[name] = bus.watch_name_owner(name, partial(_service_owner_changed, name))
+
+	if _service_present[name] or timeout == 0:
+		return _service_present[name]
+
+	logging.debug('waiting for %s' % name)
+	loop = GLib.MainLoop()
+	expired = []
+
+	def expire():
+		expired.append(True)
+		loop.quit()
+		return False
+
+	timer = GLib.timeout_add_seconds(timeout, expire)
+	_service_waiters.append(loop)
+	try:
+		loop.run()
+	finally:
+		_service_waiters.remove(loop)
+		if not expired:
+			GLib.source_remove(timer)
+
+	# signals are only received with a main loop integration, so ask once more
+	if not _service_present[name]:
+		_service_present[name] = bool(bus.name_has_owner(name))
+	return _service_present[name]
+
+## Process-wide cache of the settings of the devices
+# The values below CACHED_PREFIXES are read with a single GetItems call, and kept up to date
+# from the ItemsChanged signal of the settings service: one signal match for the process,
+# instead of one per setting of every device. The changes are dispatched to the SettingItem
+# objects, which replace VeDbusItemImport for the cached settings.
+CACHED_PREFIXES = ('/Settings/Devices/', '/Settings/ModbusClient/')
+
+class SettingsCache(VeDbusRootTracker):
+	def __init__(self, bus, serviceName):
+		VeDbusRootTracker.__init__(self, bus, serviceName)
+		self._bus = bus
+		self.values = {}
+		self.load()
+
+	def load(self):
+		items = self._bus.get_object(self.serviceName, '/', introspect=False).GetItems()
+		self.values = {
+			str(path): unwrap_dbus_value(item['Value'])
+			for path, item in items.items() if path.startswith(CACHED_PREFIXES)
+		}
+
+	def covers(self, path):
+		return path.startswith(CACHED_PREFIXES)
+
+	def item(self, path, eventCallback=None):
+		item = SettingItem(self, path, eventCallback)
+		self.add(item)
+		return item
+
+	def _items_changed_handler(self, items):
+		if not isinstance(items, dict):
+			return
+
+		for path, changes in items.items():
+			if path.startswith(CACHED_PREFIXES) and 'Value' in changes:
+				self.values[str(path)] = unwrap_dbus_value(changes['Value'])
+
+		VeDbusRootTracker._items_changed_handler(self, items)
+
+_settings_caches = {}
+
+## Returns the settings cache of the process for the given settings service
+# None when the service does not support GetItems, the settings are then imported one by one.
+def settings_cache(bus, name):
+	if name not in _settings_caches:
+		try:
+			_settings_caches[name] = SettingsCache(bus, name)
+		except dbus.exceptions.DBusException as e:
+			logging.debug("Settings of %s not cached: %s" % (name, e))
+			_settings_caches[name] = None
+	return _settings_caches[name]
+
+## A setting read from the SettingsCache
+# Provides the part of the VeDbusItemImport interface used by SettingsDevice.
+class SettingItem(object):
+	def __init__(self, cache, path, eventCallback=None):
+		self._cache = cache
+		self._path = path
+		self._proxy = cache._bus.get_object(cache.serviceName, path, introspect=False)
+		self.eventCallback = eventCallback
+
+	@property
+	def path(self):
+		return self._path
+
+	@property
+	def serviceName(self):
+		return self._cache.serviceName
+
+	@property
+	def exists(self):
+		return self._path in self._cache.values
+
+	def get_value(self):
+		return self._cache.values.get(self._path)
+
+	def set_value(self, newvalue):
+		r = self._proxy.SetValue(wrap_dbus_value(newvalue))
+		if r == 0:
+			self._cache.values[self._path] = newvalue
+		return r
+
+	def set_default(self):
+		self._proxy.SetDefault()
+
+	def _properties_changed_handler(self, changes):
+		if "Value" in changes:
+			changes['Value'] = unwrap_dbus_value(changes['Value'])
+			if self.eventCallback:
+				self.eventCallback(self.serviceName, self._path, changes)
+
+# Prepare to add a setting. Most dbus types extend the python
+# type so it is only necessary to additionally test for Int64.
+def _itemType(value):
+	if isinstance(value, (int, dbus.Int64)):
+		return 'i'
+	if isinstance(value, float):
+		return 'f'
+	return 's'
+
 ## The Settings Device class.
 # Used by python programs, such as the vrm-logger, to read and write settings they
 # need to store on disk. And since these settings might be changed from a different
@@ -43,29 +197,81 @@ class SettingsDevice(object):
 		self._values = {} # stored the values, used to pass the old value along on a setting change
 		self._settings = {}
 
-		count = 0
-		while True:
-			if 'com.victronenergy.settings' in self._bus.list_names():
-				break
-			if count == timeout:
-				raise Exception("The settings service com.victronenergy.settings does not exist!")
-			count += 1
-			logging.debug('waiting for settings')
-			time.sleep(1)
+		if not wait_for_service(self._bus, self._dbus_name, timeout):
+			raise Exception("The settings service %s does not exist!" % self._dbus_name)
+
+		self._cache = settings_cache(self._bus, self._dbus_name)
 
 		# Add the items.
 		self.addSettings(supportedSettings)
 
 		logging.debug("===== Settings device init finished =====")
 
+	## Adds the settings, creating them or adjusting their attributes when needed
+	# All the settings are passed to localsettings in a single AddSettings call, and their values
+	# are read from the settings cache, which is only reloaded when a setting was just created.
+	# Settings which could not be added that way, for instance with a localsettings not
+	# supporting these calls, are added one by one.
 	def addSettings(self, settings):
-		for setting, options in settings.items():
+		remaining = self._addSettingsBulk(settings)
+		for setting in remaining:
+			options = settings[setting]
 			silent = len(options) > SILENT and options[SILENT]
 			busitem = self.addSetting(options[PATH], options[VALUE],
 				options[MINIMUM], options[MAXIMUM], silent, callback=partial(self.handleChangedSetting, setting))
 			self._settings[setting] = busitem
 			self._values[setting] = busitem.get_value()
 
+	# Returns the names of the settings which were not added
+	def _addSettingsBulk(self, settings):
+		if not settings or self._cache is None:
+			return list(settings)
+
+		# Without introspection dbus-python cannot guess the signature of a list of
+		# dictionaries with values of mixed types, so the request is fully typed.
+		request = dbus.Array(signature='a{sv}')
+		for setting, options in settings.items():
+			request.append(dbus.Dictionary({
+				'path': dbus.String(options[PATH].replace('/Settings/', '', 1)),
+				'default': wrap_dbus_value(options[VALUE]),
+				'type': dbus.String(_itemType(options[VALUE])),
+				'min': wrap_dbus_value(options[MINIMUM]),
+				'max': wrap_dbus_value(options[MAXIMUM]),
+				'silent': dbus.Boolean(len(options) > SILENT and options[SILENT]),
+			}, signature='sv'))
+
+		try:
+			settings_item = self._bus.get_object(self._dbus_name, '/Settings', introspect=False)
+			results = settings_item.AddSettings(request, signature='aa{sv}')
+
+			failed = set(str(r.get('path')) for r in results if r.get('error', 0) != 0)
+			added = [options[PATH] for options in settings.values()
+				if options[PATH].replace('/Settings/', '', 1) not in failed]
+
+			if not all(p in self._cache.values for p in added if self._cache.covers(p)):
+				self._cache.load()
+		except dbus.exceptions.DBusException as e:
+			logging.debug("Bulk add of settings failed: %s" % e)
+			return list(settings)
+
+		remaining = []
+		for setting, options in settings.items():
+			path = options[PATH]
+			callback = partial(self.handleChangedSetting, setting)
+			if path not in added:
+				remaining.append(setting)
+				continue
+
+			if self._cache.covers(path) and path in self._cache.values:
+				busitem = self._cache.item(path, callback)
+			else:
+				busitem = VeDbusItemImport(self._bus, self._dbus_name, path, callback)
+
+			self._settings[setting] = busitem
+			self._values[setting] = busitem.get_value()
+
+		return remaining
+
 	def addSetting(self, path, value, _min, _max, silent=False, callback=None):
 		busitem = VeDbusItemImport(self._bus, self._dbus_name, path, callback)
 		if busitem.exists and (value, _min, _max, silent) == busitem._proxy.GetAttributes():
@@ -73,14 +279,7 @@ class SettingsDevice(object):
 		else:
 			logging.debug("Setting %s does not exist yet or must be adjusted" % path)
 
-			# Prepare to add the setting. Most dbus types extend the python
-			# type so it is only necessary to additionally test for Int64.
-			if isinstance(value, (int, dbus.Int64)):
-				itemType = 'i'
-			elif isinstance(value, float):
-				itemType = 'f'
-			else:
-				itemType = 's'
+			itemType = _itemType(value)
 
 			# Add the setting
 			# TODO, make an object that inherits VeDbusItemImport, and complete the D-Bus settingsitem interface
@@ -108,6 +307,9 @@ class SettingsDevice(object):
                 item = VeDbusItemImport(self._bus, self._dbus_name, path, createsignal=False)
                 item.set_default()
 
+	def __contains__(self, setting):
+		return setting in self._settings
+
 	def __getitem__(self, setting):
 		return self._settings[setting].get_value()
 
@@ -116,3 +318,127 @@ class SettingsDevice(object):
 		if result != 0:
 			# Trying to make some false change to our own settings? How dumb!
 			assert False
+
+
+if __name__ == '__main__':
+	# Benchmark of the creation of device settings against a stand-in for localsettings, on
+	# the session bus. Run with: dbus-run-session python3 settingsdevice.py
+	import os
+	import signal
+	import time
+	import dbus.service
+	from dbus.mainloop.glib import DBusGMainLoop
+	from vedbus import VeDbusService, VeDbusTreeExport, VeDbusItemExport
+
+	class StandInItem(VeDbusItemExport):
+		attributes = None
+
+		@dbus.service.method('com.victronenergy.Settings', out_signature='vvvi')
+		def GetAttributes(self):
+			return self.attributes
+
+	class StandInSettings(VeDbusTreeExport):
+		@dbus.service.method('com.victronenergy.Settings', in_signature='ssvsvv', out_signature='i')
+		def AddSetting(self, group, name, default, itemtype, minimum, maximum):
+			return self._service.add_setting(name, default, minimum, maximum, 0)
+
+		@dbus.service.method('com.victronenergy.Settings', in_signature='ssvsvv', out_signature='i')
+		def AddSilentSetting(self, group, name, default, itemtype, minimum, maximum):
+			return self._service.add_setting(name, default, minimum, maximum, 1)
+
+		@dbus.service.method('com.victronenergy.Settings', in_signature='aa{sv}', out_signature='aa{sv}')
+		def AddSettings(self, settings):
+			return [{'path': s['path'], 'error': self._service.add_setting(s['path'], s['default'],
+					s.get('min', 0), s.get('max', 0), int(s.get('silent', 0)))}
+				for s in settings]
+
+	class StandInService(VeDbusService):
+		def _create_item(self, path, value, description, writeable, gettextcallback, valuetype):
+			return StandInItem(self._dbusconn, path, value, description, True,
+				onchangecallback=self._setting_changed, deletecallback=self._item_deleted)
+
+		# localsettings also signals the changes on its root
+		def _setting_changed(self, path, value):
+			self._dbusnodes['/'].ItemsChanged({path: {'Value': wrap_dbus_value(value),
+				'Text': dbus.String(value)}})
+			return True
+
+		def add_setting(self, name, default, minimum, maximum, silent):
+			path = '/Settings/' + name
+			if path not in self:
+				self.add_path(path, unwrap_dbus_value(default))
+			self._dbusobjects[path].attributes = (default, minimum, maximum, silent)
+			return 0
+
+	pid = os.fork()
+	if pid == 0:
+		DBusGMainLoop(set_as_default=True)
+		bus = dbus.SessionBus()
+		service = StandInService('com.victronenergy.settings', bus)
+		service._dbusnodes['/Settings'] = StandInSettings(bus, '/Settings', service)
+		GLib.MainLoop().run()
+		os._exit(0)
+
+	class OneByOne(SettingsDevice):
+		def _addSettingsBulk(self, settings):
+			return list(settings)
+
+	DBusGMainLoop(set_as_default=True)
+	bus = dbus.SessionBus()
+	wait_for_service(bus, 'com.victronenergy.settings', 10)
+
+	# The items of a SettingsDevice refer back to it through their callbacks. Break the cycle
+	# when done with it, as ModbusDevice.destroy does: an item collected by the garbage
+	# collector while dbus-python holds its signal lock would deadlock in __del__.
+	def release(settings):
+		settings._settings = None
+
+	# check the values and attributes of settings added in bulk, and the changes received
+	# through the settings cache
+	path = '/Settings/Devices/check'
+	checked = {
+		'instance':   [path + '/ClassAndVrmInstance', 'grid:40', 0, 0],
+		'position':   [path + '/Position', 0, 0, 2],
+		'limit':      [path + '/Limit', 1.5, 0.0, 10.0],
+	}
+	changes = []
+	s = SettingsDevice(bus, checked, lambda *change: changes.append(change))
+	assert [s[n] for n in checked] == ['grid:40', 0, 1.5], [s[n] for n in checked]
+
+	attributes = bus.get_object('com.victronenergy.settings', path + '/Limit').GetAttributes()
+	assert attributes == (1.5, 0.0, 10.0, 0) and isinstance(attributes[0], dbus.Double), attributes
+
+	other = dbus.SessionBus(private=True)
+	other.get_object('com.victronenergy.settings', path + '/ClassAndVrmInstance').SetValue('pvinverter:41')
+	loop = GLib.MainLoop()
+	GLib.timeout_add(200, loop.quit)
+	loop.run()
+	other.close()
+	assert changes == [('instance', 'grid:40', 'pvinverter:41')], changes
+	release(s)
+	s = SettingsDevice(bus, checked, None)
+	assert s['instance'] == 'pvinverter:41'
+	release(s)
+	print('settings added in bulk: values, attributes and changes checked')
+
+	def bring_up(cls, n, prefix):
+		t0 = time.time()
+		for i in range(n):
+			path = '/Settings/Devices/%s_%d' % (prefix, i)
+			release(cls(bus, {
+				'instance':   [path + '/ClassAndVrmInstance', 'grid:40', 0, 0],
+				'customname': [path + '/CustomName', '', 0, 0],
+				'position':   [path + '/Position', 0, 0, 2],
+			}, None))
+		return time.time() - t0
+
+	try:
+		for n in (1, 10, 50):
+			for cls in (OneByOne, SettingsDevice):
+				prefix = '%s_%d' % (cls.__name__, n)
+				create = bring_up(cls, n, prefix)
+				reinit = bring_up(cls, n, prefix)
+				print('%3d devices %-14s create %8.1f ms, reinit %8.1f ms' % (
+					n, cls.__name__, create * 1e3, reinit * 1e3))
+	finally:
+		os.kill(pid, signal.SIGTERM)
@@ -8,271 +8,397 @@ import logging
 import device
 import probe
 from register import *
+from sunspecmodels import *
 
 # other additionnal import because of new read_data_regs
-from copy import copy
+from collections import namedtuple
+from functools import partial
 import time
 import traceback
 from pymodbus.client.sync import *
-from pymodbus.register_read_message import ReadHoldingRegistersResponse
 
 log = logging.getLogger()
 
+# Block of registers read for a sub-device of a SunspecHub
+DataBlock = namedtuple('DataBlock', ['base', 'count', 'dev', 'regs'])
+
+# Number of read plans compiled by a device before they are flushed
+MAX_READ_PLANS = 64
+
+# 'SunS' identifier at register 40000
+SUNSPEC_MARKER = 0x53756e53
+
+# Number of models beyond which a chain is considered broken
+MAX_MODELS = 64
+
 class SunspecDevice (device.EnergyMeter):
     def __init__(self, *args):
         super(SunspecDevice, self).__init__(*args)
 
-    def read_data_regs(self, regs, d):
+    def compile_data_regs(self):
+        # the data registers are kept in a single block for the D-Bus
+        # paths and the scales, the registers actually read are chosen
+        # at each poll by read_plan()
+        self.sf_groups = {}
+        for reg in self.data_regs:
+            reg.sf_reg = self.scale_factors.get(self.sf_map.get(reg.base))
+            if reg.sf_reg is not None:
+                self.sf_groups.setdefault(id(reg.sf_reg), []).append(reg)
+        self.sf_ids = set(id(r) for r in self.scale_factors.values())
+        self.plans = {}
+        return [RegBlock(self.data_regs, self.block_start, self.block_length)]
+
+    def read_plan(self, now):
+        # only the stale data registers are read, together with their
+        # scale factors, packed into as few transactions as the overhead
+        # model of pack_regs allows.  The decoders are compiled once for
+        # each composition of a transaction.  A scale factor is always
+        # read with all the data registers of its group, so that no
+        # value scaled with an outdated scale factor is kept.
+        regs = []
+        sfs = []
+        for r in self.data_regs[0]:
+            if now - r.time >= r.max_age:
+                sf = r.sf_reg
+                if sf is None:
+                    regs.append(r)
+                elif not any(s is sf for s in sfs):
+                    sfs.append(sf)
+                    regs += self.sf_groups[id(sf)]
+
+        if not regs:
+            return []
+
+        plan = []
+        for group in self.pack_regs(regs + sfs):
+            key = tuple(id(r) for r in group)
+            block = self.plans.get(key)
+            if block is None:
+                if len(self.plans) >= MAX_READ_PLANS:
+                    self.plans.clear()
+                block = self.plans[key] = RegBlock(group)
+            plan.append(block)
+
+        return plan
+
+    def poll(self):
         now = time.time()
-        
-        if all(now - r.time < r.max_age for r in regs):
-            return
-        # changed 2 lines to manage sunspec map
-        start = self.block_start
-        count = self.block_length
-        
-        rr = self.modbus.read_holding_registers(start, count, unit=self.unit)
-
-        latency = time.time() - now
-
-        if not isinstance(rr, ReadHoldingRegistersResponse):
-            log.error('Error reading registers %#04x-%#04x: %s',
-                      start, start + count - 1, rr)
-            raise Exception(rr)
-        
+        blocks = []
+
+        for regs in self.read_plan(now):
+            values = self.read_data_block(regs.start, regs.count)
+            blocks.append((regs, values, time.time() - now))
+
+        return now, blocks
+
+    def publish(self, data):
         # following is all changed to fit with sunspec map
         # calculate and allocate the scale factors
-        for group, reg in self.scale_factors.items():
-            base = reg.base - start
-            end = base + reg.count
-            reg.decode(rr.registers[base:end])
-
-        for reg in regs:
-            if reg.base in self.sf_map:
-                reg_group = self.sf_map[reg.base]
-                reg_sign = self.scale_signs[reg_group]
-                reg_sf = self.scale_factors[reg_group].value
-                reg.scale = float(reg_sign / 10**(reg_sf))
-            else:
-                reg.scale = 1
-            base = reg.base - start
-            end = base + reg.count
-
-            if now - reg.time > reg.max_age:
-                if reg.decode(rr.registers[base:end]):
-                    d[reg.name] = copy(reg) if reg.isvalid() else None
+        # the scales of the data registers are only recalculated
+        # when a scale factor has actually changed.  The scale factors
+        # of all the blocks read are decoded before any data register,
+        # a group may have been packed into several blocks.
+        now, blocks = data
+        blocks = [(regs, regs.decode(values), t) for regs, values, t in blocks]
+
+        sf_changed = False
+        for regs, raw_values, t in blocks:
+            for reg, raw in raw_values:
+                if id(reg) in self.sf_ids and reg.set_raw_value(raw):
+                    sf_changed = True
+
+        if sf_changed:
+            self.update_scales()
+
+        super(SunspecDevice, self).publish((now, blocks))
+
+    def valid_sf(self, reg):
+        return reg.value is not None and SF_MIN <= reg.value <= SF_MAX
+
+    def decode_data_regs(self, regs, raw_values, now, d):
+        # the values were decoded by publish()
+        for reg, raw in raw_values:
+            if id(reg) not in self.sf_ids:
+                if reg.sf_reg is None or self.valid_sf(reg.sf_reg):
+                    changed = reg.set_raw_value(raw)
+                else:
+                    changed = reg.update(None)
+                reg.schedule(changed)
                 reg.time = now
+                if reg.publish(now):
+                    d[reg.name] = reg.value
+
+    def update_scales(self):
+        # a scale factor out of range, 0x8000 when not implemented,
+        # gives no scale: the registers of its group keep their scale
+        # and are decoded as None
+        scales = {}
+        for group, reg in self.scale_factors.items():
+            if self.valid_sf(reg):
+                scales[group] = float(self.scale_signs[group] / 10**(reg.value))
 
-        return latency
+        # registers without scale factor keep the scale they were
+        # created with
+        for regs in self.data_regs:
+            for reg in regs:
+                group = self.sf_map.get(reg.base)
+                if group in scales:
+                    reg.scale = scales[group]
 
     def get_ident(self):
         #return 'se_%s' % self.info['/Serial']
         return 'se_%s' % self.id
 
-class SunspecMeter(SunspecDevice):
-    productid = 203
-    productname = 'Solaredge Sunspec Meter'
-    min_timeout = 0.5
-    
-    def __init__(self, *args):
-        super(SunspecMeter, self).__init__(*args)
-        self.id=203
-        self.role='grid'
-        self.info_regs = [
-            Reg_text( 40163, 8, '/FirmwareVersion'),
-            Reg_text( 40171, 16, '/Serial'),
-       ]
+class SunspecModelDevice(SunspecDevice):
+    '''Device of a Sunspec map described by a model of sunspecmodels
 
-    def device_init(self):
-        #print(os.path.abspath(__file__), '>entering SunspecMeter.device_init')
-        self.read_info()
-        #print(os.path.abspath(__file__), '>in SunspecMeter.device_init, read_info() completed ')
-
-        self.block_start=40190    #1st register to read for data_registers
-        self.block_length=105     #Number of registers to read for data_registers (include scale factors)
-        #print(os.path.abspath(__file__), 'in SunspecMeter.device_init', self.map_start, self.map_count)
-        '''
-        Ancienne définition des data_regs
-        self.data_regs=[
-            Reg_s16( 40190, '/Ac/Current', 1, '%.1f A'),
-            Reg_s16( 40191, '/Ac/L1/Current', 1, '%.1f A'),
-            Reg_s16( 40192, '/Ac/L2/Current', 1, '%.1f A'),
-            Reg_s16( 40193, '/Ac/L3/Current', 1, '%.1f A'),
-            Reg_s16( 40195, '/Ac/Voltage', 1, '%.1f V'),
-            Reg_s16( 40196, '/Ac/L1/Voltage', 1, '%.1f V'),
-            Reg_s16( 40197, '/Ac/L2/Voltage', 1, '%.1f V'),
-            Reg_s16( 40198, '/Ac/L3/Voltage', 1, '%.1f V'),
-            Reg_s16( 40204, '/Ac/Frequency', 1, '%.1f Hz'),
-            Reg_s16( 40206, '/Ac/Power', 1, '%.1f W'),
-            Reg_s16( 40207, '/Ac/L1/Power', 1, '%.1f W'),
-            Reg_s16( 40208, '/Ac/L2/Power', 1, '%.1f W'),
-            Reg_s16( 40209, '/Ac/L3/Power', 1, '%.1f W'),
-            Reg_u32b( 40226, '/Ac/Energy/Forward', 1, '%.1f kWh'),
-            Reg_u32b( 40234, '/Ac/Energy/Reverse', 1, '%.1f kWh'),
-        ]
-        '''
-        # 2023-09-18
-        # nouvelle définition des dataregs pour fonctionnement monophasé
-        # inversion Forward et Reverse car faux dans version initiale
-        self.data_regs=[
-            Reg_s16( 40190, '/Ac/Current', 1, '%.1f A'),
-            Reg_s16( 40191, '/Ac/L1/Current', 1, '%.1f A'),
-            Reg_s16( 40195, '/Ac/Voltage', 1, '%.1f V'),
-            Reg_s16( 40196, '/Ac/L1/Voltage', 1, '%.1f V'),
-            Reg_s16( 40204, '/Ac/Frequency', 1, '%.1f Hz'),
-            Reg_s16( 40206, '/Ac/Power', 1, '%.1f W'),
-            Reg_s16( 40207, '/Ac/L1/Power', 1, '%.1f W'),
-            Reg_u32b( 40226, '/Ac/Energy/Reverse', 1, '%.1f kWh'),
-            Reg_u32b( 40234, '/Ac/Energy/Forward', 1, '%.1f kWh'),
-            Reg_u32b( 40234, '/Ac/L1/Energy/Forward', 1, '%.1f kWh'),
-        ]
-
-        self.scale_factors={
-            'Current' : Reg_s16( 40194),
-            'Voltage' : Reg_s16( 40203),
-            'Frequency' : Reg_s16( 40205),
-            'Power' : Reg_s16( 40210),
-            'Energy' : Reg_s16( 40242),
-        }
-
-        self.scale_signs={
-            'Current' : 1,
-            'Voltage' : 1,
-            'Frequency' : 1,
-            'Power' : -1,
-            'Energy' : 1000,
-        }
+    The device is made of the model with ID `model_id` at register
+    `base` and of the common model at register `common` preceding it
+    in the chain, which holds its identification.  Its data registers,
+    scale factors and role all come from the description `desc`.
 
-        self.sf_map={
-            40190 : 'Current',
-            40191 : 'Current',
-            40192 : 'Current',
-            40193 : 'Current',
-            40195 : 'Voltage',
-            40196 : 'Voltage',
-            40197 : 'Voltage',
-            40198 : 'Voltage',
-            40204 : 'Frequency',
-            40206 : 'Power',
-            40207 : 'Power',
-            40208 : 'Power',
-            40209 : 'Power',
-            40226 : 'Energy',
-            40234 : 'Energy',
-        }
-        #print(os.path.abspath(__file__), '>SunspecMeter.device_init completed')
+    '''
 
-class SunspecInverter(SunspecDevice):
-    productid = 101
-    productname = 'Solaredge Sunspec Inverter'
     min_timeout = 0.5
-    
-    def __init__(self, *args):
-        super(SunspecInverter, self).__init__(*args)
-        self.id=101
-        self.role='pvinverter'
-        self.pos_item = 0 # 0=AC input 1;1=AC output;2=AC input 2
-        self.info_regs = [
-            Reg_text( 40044, 8, '/FirmwareVersion'),
-            Reg_text( 40052, 16, '/Serial'),
-        ]
+
+    def __init__(self, modbus, unit, model, model_id, desc, base, common,
+                 ident):
+        super(SunspecModelDevice, self).__init__(modbus, unit, model)
+        self.id = ident
+        self.desc = desc
+        self.base = base
+        self.productid = model_id
+        self.productname = desc.productname
+        self.role = self.default_role = desc.role
+        self.allowed_roles = desc.roles
+        self.id_reg = Reg_u16(base)
+
+        offset, count = COMMON_MODEL_NAME
+        self.model_reg = Reg_text(common + offset, count, '/Model')
+        self.info_regs = [Reg_text(common + offset, count, name)
+                          for offset, count, name in COMMON_INFO]
 
     def device_init(self):
-        #print(os.path.abspath(__file__), '>entering SunspecInverter.device_init')
         self.read_info()
-        #print(os.path.abspath(__file__), '>in SunspecInverter.device_init, read_info() completed ')
-        self.block_start=40071    #1st register to read for data_registers
-        self.block_length=39      #Number of registers to read for data_registers (include scale factors)
-        #print(os.path.abspath(__file__), 'in SunspecInverter.device_init', self.map_start, self.map_count)
-        #Table de données dans le format Sunspec
-        self.data_regs=[
-            Reg_u16( 40071, '/Ac/Current', 1, '%.1f A'),
-            Reg_s16( 40071, '/Ac/L1/Current', 1, '%.1f A'),
-            Reg_u16( 40076, '/Ac/Voltage', 1, '%.1f V'),
-            Reg_s16( 40076, '/Ac/L1/Voltage', 1, '%.1f V'),
-            Reg_u16( 40085, '/Ac/Frequency', 1, '%.1f Hz'),
-            Reg_s16( 40083, '/Ac/Power', 1, '%.1f W'),
-            Reg_s16( 40083, '/Ac/L1/Power', 1, '%.1f W'),
-            Reg_u32b( 40093, '/Ac/Energy/Forward', 1, '%.1f kWh'),
-            Reg_u32b( 40093, '/Ac/L1/Energy/Forward', 1, '%.1f kWh'),
-            Reg_u16( 40107, '/Status'),
-        ]
 
-        self.scale_factors={
-            'Current' : Reg_s16( 40075),
-            'Voltage' : Reg_s16( 40082),
-            'Frequency' : Reg_s16( 40086),
-            'Power' : Reg_s16( 40084),
-            'Energy' : Reg_s16( 40095),
-        }
+        desc = self.desc
+        base = self.base
 
-        self.scale_signs={
-            'Current' : 1,
-            'Voltage' : 1,
-            'Frequency' : 1,
-            'Power' : 1,
-            'Energy' : 1000,
-        }
+        self.block_start = base
+        self.block_length = desc.length + 2
 
-        self.sf_map={
-            40071 : 'Current',
-            40076 : 'Voltage',
-            40085 : 'Frequency',
-            40083 : 'Power',
-            40093 : 'Energy',
-        }
-        #print(os.path.abspath(__file__), '>SunspecInverter.device_init completed')
+        self.data_regs = [
+            p.reg(base + p.offset, p.name, p.scale, p.text, **p.options)
+            for p in desc.points
+        ]
+
+        self.scale_factors = {}
+        self.scale_signs = {}
+        for group, (offset, sign) in desc.scale_factors.items():
+            self.scale_factors[group] = Reg_s16(base + offset)
+            self.scale_signs[group] = sign
+
+        self.sf_map = {base + p.offset: p.sf for p in desc.points if p.sf}
+
+# Maps of the devices of this installation, read as they always have
+# been rather than with the generic descriptions of their models.  They
+# only apply to the first device of their model, se_101 and se_203.
+# Their registers have no 'not implemented' values.
+se_point = partial(point, invalid=None)
+
+SE_MODELS = {
+    # SE3000H-RW000BNN4, monophasé
+    101: Model('Solaredge Sunspec Inverter', 'pvinverter', AC_ROLES, 50, [
+        se_point( 2, Reg_u16,  '/Ac/Current', '%.1f A', 'Current'),
+        se_point( 2, Reg_s16,  '/Ac/L1/Current', '%.1f A', 'Current'),
+        se_point( 7, Reg_u16,  '/Ac/Voltage', '%.1f V', 'Voltage'),
+        se_point( 7, Reg_s16,  '/Ac/L1/Voltage', '%.1f V', 'Voltage'),
+        se_point(16, Reg_u16,  '/Ac/Frequency', '%.1f Hz', 'Frequency'),
+        se_point(14, Reg_s16,  '/Ac/Power', '%.1f W', 'Power'),
+        se_point(14, Reg_s16,  '/Ac/L1/Power', '%.1f W', 'Power'),
+        se_point(24, Reg_u32b, '/Ac/Energy/Forward', '%.1f kWh', 'Energy'),
+        se_point(24, Reg_u32b, '/Ac/L1/Energy/Forward', '%.1f kWh', 'Energy'),
+        se_point(38, Reg_u16,  '/Status'),
+    ], {
+        'Current':      (6, 1),
+        'Voltage':      (13, 1),
+        'Frequency':    (17, 1),
+        'Power':        (15, 1),
+        'Energy':       (26, 1000),
+    }),
+
+    # WND-3Y-400-MB
+    # 2023-09-18
+    # nouvelle définition des dataregs pour fonctionnement monophasé
+    # inversion Forward et Reverse car faux dans version initiale
+    # pas de bande morte sur les puissances du compteur réseau,
+    # utilisées pour la régulation ESS
+    203: Model('Solaredge Sunspec Meter', 'grid', AC_ROLES, 105, [
+        se_point( 2, Reg_s16,  '/Ac/Current', '%.1f A', 'Current'),
+        se_point( 3, Reg_s16,  '/Ac/L1/Current', '%.1f A', 'Current'),
+        se_point( 7, Reg_s16,  '/Ac/Voltage', '%.1f V', 'Voltage'),
+        se_point( 8, Reg_s16,  '/Ac/L1/Voltage', '%.1f V', 'Voltage'),
+        se_point(16, Reg_s16,  '/Ac/Frequency', '%.1f Hz', 'Frequency'),
+        se_point(18, Reg_s16,  '/Ac/Power', '%.1f W', 'Power', deadband=0),
+        se_point(19, Reg_s16,  '/Ac/L1/Power', '%.1f W', 'Power', deadband=0),
+        se_point(38, Reg_u32b, '/Ac/Energy/Reverse', '%.1f kWh', 'Energy'),
+        se_point(46, Reg_u32b, '/Ac/Energy/Forward', '%.1f kWh', 'Energy'),
+        se_point(46, Reg_u32b, '/Ac/L1/Energy/Forward', '%.1f kWh', 'Energy'),
+    ], {
+        'Current':      (6, 1),
+        'Voltage':      (15, 1),
+        'Frequency':    (17, 1),
+        'Power':        (22, -1),
+        'Energy':       (54, 1000),
+    }),
+}
 
 class SunspecHub(device.ModbusDevice):
     def __init__(self, *args):
         #print(os.path.abspath(__file__), '>Entering SunspecHub.__init__')
         super(SunspecHub, self).__init__(*args)
         self.sunspec_devices=[]
-        self.dev_id_regs=[
-            Reg_u16( 40069),
-            Reg_u16( 40188),
-        ]
-        self.sunspec_blocks = {
-            101:{'model' : 'SE3000H-RW000BNN4', 'handler' : SunspecInverter},
-            203:{'model' : 'WND-3Y-400-MB', 'handler' : SunspecMeter},
-        }
+        self.found_devices = None
+        self.chain = None
+        self.sunspec_models = MODELS
+        self.first_models = SE_MODELS
+
+    def destroy(self):
+        # devices discovered by a probe whose result was dropped
+        for d in self.found_devices or []:
+            d.destroy()
+        self.found_devices = None
+        super(SunspecHub, self).destroy()
+
+    def walk_models(self):
+        # Follow the chain of models from the first one to the end
+        # marker, one read of the ID and length of each model.  The
+        # chain is returned as a list of [base, ID, length].
+        chain = []
+        addr = SUNSPEC_START
+
+        while len(chain) < MAX_MODELS and addr + 2 <= 0x10000:
+            model_id, length = self.read_data_block(addr, 2)
+            if model_id == END_MODEL:
+                return chain
+            chain.append([addr, model_id, length])
+            addr += 2 + length
+
+        raise Exception('Sunspec model chain of %s has no end' % self)
+
+    def create_devices(self, chain):
+        # A device is created for each model having a description, with
+        # the common model preceding it.  The first device of a model
+        # keeps the ident and the map it always had, the next ones are
+        # numbered and read with the generic description.
+        devs = []
+        count = {}
+        common = None
+
+        for base, model_id, length in chain:
+            if model_id == COMMON_MODEL:
+                common = base
+                continue
 
-    def probe_sunspec(self, reg):
-        rr = self.modbus.read_holding_registers(reg.base, reg.count, unit=self.unit)
+            desc = self.sunspec_models.get(model_id)
+            if desc is None or common is None or length < desc.length:
+                log.info('Ignoring Sunspec model %d at %d', model_id, base)
+                continue
+
+            n = count[model_id] = count.get(model_id, 0) + 1
+            ident = str(model_id)
+            if n > 1:
+                ident += '_%d' % n
+            else:
+                desc = self.first_models.get(model_id, desc)
 
-        """
-        if not isinstance(rr, ReadHoldingRegistersResponse):
-            log.debug('%s: %s', modbus, rr)
+            d = SunspecModelDevice(self.modbus, self.unit, desc.productname,
+                                   model_id, desc, base, common, ident)
+            d.method = self.method
+            d.latency = self.latency
+            devs.append(d)
+
+        return devs
+
+    def read_devices(self, chain):
+        # The ID and the information registers of all devices of the
+        # chain are read together, in as few transactions as pack_regs
+        # allows.  The devices are returned if the IDs read match the
+        # chain, None otherwise.
+        devs = self.create_devices(chain)
+
+        regs = []
+        for d in devs:
+            regs += [d.id_reg, d.model_reg] + d.info_regs
+
+        valid = False
+        try:
+            for group in self.pack_regs(regs) if regs else []:
+                block = RegBlock(group)
+                values = self.read_data_block(block.start, block.count)
+                for reg, raw in block.decode(values):
+                    reg.set_raw_value(raw)
+
+            valid = all(d.id_reg.value == d.productid for d in devs)
+        finally:
+            if not valid:
+                for d in devs:
+                    d.destroy()
+
+        if not valid:
             return None
-        """
-        if not isinstance(rr, ReadHoldingRegistersResponse):
-            log.error('Error reading register %#04x: %s', reg.base, rr)
-            raise Exception(rr)
-
-        reg.decode(rr.registers)
-
-        if not reg.value in self.sunspec_blocks:
-            log.error('unknown sunspec block id: %s', reg.value)
-            raise Exception(rr)
-            #return None
-        m = self.sunspec_blocks[reg.value]
-        """
-        print(os.path.abspath(__file__), '>In SunspecHub.probe, m: ', m)
-        print(os.path.abspath(__file__), '>In SunspecHub.probe, probed device: ', 
-            m['handler'](self.modbus, self.unit, m['model']))
-        """
-        return m['handler'](self.modbus, self.unit, m['model'])
+
+        for d in devs:
+            d.info = {r.name: r for r in d.info_regs}
+            d.model = d.model_reg.value or d.model
+
+        self.chain = chain
+        return devs
+
+    def cache_entry(self):
+        return {
+            'marker':   SUNSPEC_MARKER,
+            'models':   self.chain,
+        }
+
+    def load_cache(self, entry):
+        # The cached chain tells which sub-devices to create, without
+        # walking the chain again: only their IDs and information
+        # registers are read.  The entry holds if the IDs read match.
+        chain = entry.get('models')
+        if not chain:
+            return False
+
+        devs = self.read_devices(chain)
+        if devs is None:
+            log.info('Sunspec model map at %s has changed', self)
+            return False
+
+        self.found_devices = devs
+        return True
+
+    def discover(self):
+        # Called by the probe, on its thread: the chain is walked and
+        # its devices read, init only has to put them on D-Bus.
+        chain = self.walk_models()
+        devs = self.read_devices(chain)
+        if devs is None:
+            raise Exception('Sunspec model map of %s changed' % self)
+        if not devs:
+            log.warning('No supported Sunspec model at %s: %s', self,
+                        [m[1] for m in chain])
+
+        self.found_devices = devs
 
     def init(self, dbus):
-        for reg in self.dev_id_regs:
-            d = self.probe_sunspec(reg)
+        devs = self.found_devices
+        self.found_devices = None
+        if devs is None:
+            raise Exception('No Sunspec devices discovered at %s' % self)
+
+        for d in devs:
             #print(os.path.abspath(__file__), '>In SunspecHub.init, probed device: ', d.model)
-            if not d:
-                #print(os.path.abspath(__file__), '>In SunspecHub.init, device not probed')
-                continue
             log.debug('Found %s at %s', d.model, d)
-            d.method = self.method
-            d.latency = self.latency
 
             #print(os.path.abspath(__file__), '>In SunspecHub.init, probed device: ', d)
             d.init(dbus)
@@ -280,13 +406,56 @@ class SunspecHub(device.ModbusDevice):
             #print(os.path.abspath(__file__), '>In SunspecHub.init, self.sunspec_devices', self.sunspec_devices)
             #print(os.path.abspath(__file__), '>In SunspecHub.init, SunspecHub.init() completed')
 
+    def check_reinit(self):
+        for dev in self.sunspec_devices:
+            dev.check_reinit()
 
-    def update(self):
+    def disconnect(self):
+        self.connected = False
         for dev in self.sunspec_devices:
-            dev.update()
+            dev.disconnect()
+
+    def poll(self):
+        # Plan the reads for all sub-devices together: the blocks of
+        # stale registers of each sub-device are merged into as few
+        # transactions as the overhead model of pack_regs allows, and
+        # each sub-device gets its slices of the registers read.
+        now = time.time()
+        blocks = [DataBlock(regs.start, regs.count, dev, regs)
+                  for dev in self.sunspec_devices
+                  for regs in dev.read_plan(now)]
+
+        if not blocks:
+            return []
+
+        data = {}
+
+        for group in self.pack_regs(blocks):
+            start = group[0].base
+            count = max(b.base + b.count for b in group) - start
+
+            values = self.read_data_block(start, count)
+            latency = time.time() - now
+
+            for b in group:
+                base = b.base - start
+                end = base + b.count
+                dev, dev_blocks = data.setdefault(id(b.dev), (b.dev, []))
+                dev_blocks.append((b.regs, values[base:end], latency))
+
+        return [(dev, (now, dev_blocks)) for dev, dev_blocks in data.values()]
+
+    def publish(self, data):
+        self.connected = True
+        for dev, d in data:
+            dev.publish(d)
+
+    def update(self):
+        self.check_reinit()
+        self.publish(self.poll())
 
 models = {
-    0x53756e53: {
+    SUNSPEC_MARKER: {
         'model':    'Sunspec Model Map',
         'handler':  SunspecHub,
     },
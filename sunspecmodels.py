@@ -0,0 +1,167 @@
+# Declarative descriptions of the Sunspec models handled by SunspecHub
+#
+# A Sunspec map is a chain of models starting at register 40002, right
+# after the 'SunS' marker.  Each model starts with its ID and its length
+# (number of registers following the length), the chain ends with the ID
+# 0xffff.  Each device of the map starts with a common model (ID 1)
+# holding its identification, followed by the models of its data.
+#
+# Offsets are counted from the ID register of a model, as in the tables
+# of the Sunspec specification.
+
+from collections import namedtuple
+
+import device
+from register import *
+
+COMMON_MODEL = 1
+END_MODEL = 0xffff
+
+# Register of the first model ID, after the 'SunS' marker at 40000
+SUNSPEC_START = 40002
+
+# Registers of the common model read as device information
+COMMON_MODEL_NAME = (18, 16)    # Md
+COMMON_INFO = [
+    (42, 8, '/FirmwareVersion'),    # Vr
+    (50, 16, '/Serial'),            # SN
+]
+
+# Data point of a model: offset, register class, D-Bus path and format,
+# scale factor group (None for registers without scale factor), scale
+# of a register without scale factor (the scale of the others comes from
+# their scale factor only) and options of the register
+Point = namedtuple('Point', ['offset', 'reg', 'name', 'text', 'sf', 'scale',
+                             'options'])
+
+# Raw values of the registers meaning 'not implemented', decoded as None:
+# 0xffff for uint16, 0x8000 for int16 and 0 for acc32 accumulators
+NOT_IMPLEMENTED = {
+    Reg_u16:    0xffff,
+    Reg_s16:    -0x8000,
+    Reg_u32b:   0,
+}
+
+# Scale factors range from -10 to 10, 0x8000 when not implemented
+SF_MIN = -10
+SF_MAX = 10
+
+def point(offset, reg, name, text=None, sf=None, scale=1, **options):
+    options.setdefault('invalid', NOT_IMPLEMENTED.get(reg))
+    return Point(offset, reg, name, text, sf, scale, options)
+
+# Description of a model: product name, default and allowed roles of the
+# device, minimum length of the model, data points and scale factors
+# (group: (offset, sign), the sign also giving the unit of the group)
+Model = namedtuple('Model', ['productname', 'role', 'roles', 'length',
+                             'points', 'scale_factors'])
+
+AC_ROLES = device.EnergyMeter.allowed_roles
+
+def int_inverter(productname, phases):
+    # models 101 to 103, integer values with scale factors
+    points = [
+        point( 2, Reg_u16,  '/Ac/Current', '%.1f A', 'Current'),
+        point(16, Reg_u16,  '/Ac/Frequency', '%.1f Hz', 'Frequency'),
+        point(14, Reg_s16,  '/Ac/Power', '%.1f W', 'Power'),
+        point(24, Reg_u32b, '/Ac/Energy/Forward', '%.1f kWh', 'Energy'),
+        point(38, Reg_u16,  '/Status'),
+    ]
+
+    for n in range(phases):
+        l = '/Ac/L%d' % (n + 1)
+        points += [
+            point( 3 + n, Reg_u16, l + '/Current', '%.1f A', 'Current'),
+            point(10 + n, Reg_u16, l + '/Voltage', '%.1f V', 'Voltage'),
+        ]
+
+    return Model(productname, 'pvinverter', AC_ROLES, 50, points, {
+        'Current':      (6, 1),
+        'Voltage':      (13, 1),
+        'Power':        (15, 1),
+        'Frequency':    (17, 1),
+        'Energy':       (26, 1000),
+    })
+
+def float_inverter(productname, phases):
+    # models 111 to 113, floating point values without scale factors
+    points = [
+        point( 2, Reg_f32b, '/Ac/Current', '%.1f A'),
+        point(24, Reg_f32b, '/Ac/Frequency', '%.1f Hz'),
+        point(22, Reg_f32b, '/Ac/Power', '%.1f W'),
+        point(32, Reg_f32b, '/Ac/Energy/Forward', '%.1f kWh', scale=1000),
+        point(48, Reg_u16,  '/Status'),
+    ]
+
+    for n in range(phases):
+        l = '/Ac/L%d' % (n + 1)
+        points += [
+            point( 4 + 2 * n, Reg_f32b, l + '/Current', '%.1f A'),
+            point(16 + 2 * n, Reg_f32b, l + '/Voltage', '%.1f V'),
+        ]
+
+    return Model(productname, 'pvinverter', AC_ROLES, 60, points, {})
+
+def meter(productname, phases, power_sign=1):
+    # models 201 to 204 share the same layout, only the number of
+    # phases actually used differs
+    points = [
+        point( 2, Reg_s16,  '/Ac/Current', '%.1f A', 'Current'),
+        point( 7, Reg_s16,  '/Ac/Voltage', '%.1f V', 'Voltage'),
+        point(16, Reg_s16,  '/Ac/Frequency', '%.1f Hz', 'Frequency'),
+        point(18, Reg_s16,  '/Ac/Power', '%.1f W', 'Power'),
+        point(38, Reg_u32b, '/Ac/Energy/Reverse', '%.1f kWh', 'Energy'),
+        point(46, Reg_u32b, '/Ac/Energy/Forward', '%.1f kWh', 'Energy'),
+    ]
+
+    for n in range(phases):
+        l = '/Ac/L%d' % (n + 1)
+        points += [
+            point( 3 + n, Reg_s16, l + '/Current', '%.1f A', 'Current'),
+            point( 8 + n, Reg_s16, l + '/Voltage', '%.1f V', 'Voltage'),
+            point(19 + n, Reg_s16, l + '/Power', '%.1f W', 'Power'),
+            point(40 + 2 * n, Reg_u32b, l + '/Energy/Reverse', '%.1f kWh',
+                  'Energy'),
+            point(48 + 2 * n, Reg_u32b, l + '/Energy/Forward', '%.1f kWh',
+                  'Energy'),
+        ]
+
+    return Model(productname, 'grid', AC_ROLES, 105, points, {
+        'Current':      (6, 1),
+        'Voltage':      (15, 1),
+        'Frequency':    (17, 1),
+        'Power':        (22, power_sign),
+        'Energy':       (54, 1000),
+    })
+
+def battery(productname):
+    # model 802, battery base model
+    points = [
+        point(11, Reg_u16, '/Soc', '%.1f %%', 'Soc'),
+        point(13, Reg_u16, '/Soh', '%.1f %%', 'Soh'),
+        point(34, Reg_u16, '/Dc/0/Voltage', '%.2f V', 'Voltage'),
+        point(44, Reg_s16, '/Dc/0/Current', '%.1f A', 'Current'),
+        point(47, Reg_s16, '/Dc/0/Power', '%.1f W', 'Power'),
+    ]
+
+    return Model(productname, 'battery', None, 62, points, {
+        'Soc':          (56, 1),
+        'Soh':          (58, 1),
+        'Voltage':      (59, 1),
+        'Current':      (61, 1),
+        'Power':        (63, 1),
+    })
+
+MODELS = {
+    101: int_inverter('Sunspec Single Phase Inverter', 1),
+    102: int_inverter('Sunspec Split Phase Inverter', 2),
+    103: int_inverter('Sunspec Three Phase Inverter', 3),
+    111: float_inverter('Sunspec Single Phase Inverter', 1),
+    112: float_inverter('Sunspec Split Phase Inverter', 2),
+    113: float_inverter('Sunspec Three Phase Inverter', 3),
+    201: meter('Sunspec Single Phase Meter', 1),
+    202: meter('Sunspec Split Phase Meter', 2),
+    203: meter('Sunspec Wye Meter', 3),
+    204: meter('Sunspec Delta Meter', 3),
+    802: battery('Sunspec Battery'),
+}
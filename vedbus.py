@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import dbus.lowlevel
 import dbus.service
 import logging
 import traceback
@@ -58,12 +59,20 @@ from ve_utils import wrap_dbus_value, unwrap_dbus_value
 
 # Export ourselves as a D-Bus service.
 class VeDbusService(object):
-	def __init__(self, servicename, bus=None):
+	# @param signaltext	when False, the Text of the items is left out of the PropertiesChanged
+	#					and ItemsChanged signals and only rendered on GetText and GetItems.
+	def __init__(self, servicename, bus=None, signaltext=True):
 		# dict containing the VeDbusItemExport objects, with their path as the key.
 		self._dbusobjects = {}
 		self._dbusnodes = {}
+
+		# dict containing, for each tree node ('/' included), a dict of the items below it
+		# with their path as the key. Keeps tree GetValue/GetText independent of the
+		# total number of paths.
+		self._subtrees = {}
 		self._ratelimiters = []
 		self._dbusname = None
+		self._signaltext = signaltext
 
 		# dict containing the onchange callbacks, for each object. Object path is the key
 		self._onchangecallbacks = {}
@@ -78,7 +87,7 @@ class VeDbusService(object):
 		self._dbusname = dbus.service.BusName(servicename, self._dbusconn, do_not_queue=True)
 
 		# Add the root item that will return all items as a tree
-		self._dbusnodes['/'] = VeDbusRootExport(self._dbusconn, '/', self)
+		self._dbusnodes['/'] = self._create_root()
 
 		logging.debug("registered ourselves on D-Bus as %s" % servicename)
 
@@ -88,13 +97,19 @@ class VeDbusService(object):
 		for node in list(self._dbusnodes.values()):
 			node.__del__()
 		self._dbusnodes.clear()
-		for item in list(self._dbusobjects.values()):
-			item.__del__()
+		self._drop_items()
 		self._dbusobjects.clear()
+		self._subtrees.clear()
 		if self._dbusname:
 			self._dbusname.__del__()  # Forces call to self._bus.release_name(self._name), see source code
 		self._dbusname = None
 
+	# the items are all removed, their delete callbacks have no node to prune
+	def _drop_items(self):
+		for item in self._dbusobjects.values():
+			item._deletecallback = None
+			item.__del__()
+
 	# @param callbackonchange	function that will be called when this value is changed. First parameter will
 	#							be the path of the object, second the new value. This callback should return
 	#							True to accept the change, False to reject it.
@@ -104,18 +119,91 @@ class VeDbusService(object):
 		if onchangecallback is not None:
 			self._onchangecallbacks[path] = onchangecallback
 
-		item = VeDbusItemExport(
-				self._dbusconn, path, value, description, writeable,
-				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype)
+		item = self._create_item(path, value, description, writeable, gettextcallback, valuetype)
 
 		spl = path.split('/')
-		for i in range(2, len(spl)):
-			subPath = '/'.join(spl[:i])
-			if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
-				self._dbusnodes[subPath] = VeDbusTreeExport(self._dbusconn, subPath, self)
+		self._add_nodes(['/'.join(spl[:i]) for i in range(2, len(spl))])
 		self._dbusobjects[path] = item
+		self._index_path(path, item)
 		logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
 
+	# the tree nodes a path is part of, from the root down to its parent
+	@staticmethod
+	def _parent_nodes(path):
+		nodes = ['/']
+		i = path.find('/', 1)
+		while i > 0:
+			nodes.append(path[:i])
+			i = path.find('/', i + 1)
+		return nodes
+
+	# the root is left out of the index, all the items are below it
+	def _index_path(self, path, item, nodes=None):
+		for node in (nodes or self._parent_nodes(path))[1:]:
+			self._subtrees.setdefault(node, {})[path] = item
+
+	def _unindex_path(self, path):
+		for node in self._parent_nodes(path)[1:]:
+			items = self._subtrees.get(node)
+			if items is None:
+				continue
+			items.pop(path, None)
+			if not items:
+				del self._subtrees[node]
+
+	# items below the given tree node, as a dict with their path as the key
+	def _subtree(self, path):
+		if path == '/':
+			return self._dbusobjects
+		return self._subtrees.get(path, {})
+
+	def _create_root(self):
+		return VeDbusRootExport(self._dbusconn, '/', self)
+
+	def _create_item(self, path, value, description, writeable, gettextcallback, valuetype):
+		return VeDbusItemExport(
+				self._dbusconn, path, value, description, writeable,
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype,
+				signaltext=self._signaltext)
+
+	# Create the tree objects of the given intermediate nodes, except those which are,
+	# or are about to become, items themselves
+	def _add_nodes(self, nodes, newpaths=()):
+		for subPath in nodes:
+			if subPath not in self._dbusnodes and subPath not in self._dbusobjects and \
+					subPath not in newpaths:
+				self._dbusnodes[subPath] = VeDbusTreeExport(self._dbusconn, subPath, self)
+
+	## Add several paths at once
+	# @param paths	list of tuples (path, value) or (path, value, kwargs), where kwargs is a dict
+	#				with the keyword arguments of add_path.
+	# The tree nodes of each path are computed once, to create the missing ones before
+	# the items and to index the items, and a single debug line is logged instead of a
+	# formatted one per path.
+	def add_paths(self, paths):
+		paths = [(p[0], p[1], p[2] if len(p) == 3 else {}, self._parent_nodes(p[0]))
+			for p in paths]
+		newpaths = set(p[0] for p in paths)
+
+		nodes = set()
+		for path, value, kwargs, parents in paths:
+			nodes.update(parents[1:])
+
+		self._add_nodes(sorted(nodes), newpaths)
+
+		for path, value, kwargs, parents in paths:
+			onchangecallback = kwargs.get('onchangecallback')
+			if onchangecallback is not None:
+				self._onchangecallbacks[path] = onchangecallback
+
+			item = self._create_item(
+					path, value, kwargs.get('description', ""), kwargs.get('writeable', False),
+					kwargs.get('gettextcallback'), kwargs.get('valuetype'))
+			self._dbusobjects[path] = item
+			self._index_path(path, item, parents)
+
+		logging.debug('added %d paths', len(paths))
+
 	# Add the mandatory paths, as per victron dbus api doc
 	def add_mandatory_paths(self, processname, processversion, connection,
 			deviceinstance, productid, productname, firmwareversion, hardwareversion, connected):
@@ -139,16 +227,15 @@ class VeDbusService(object):
 
 		return self._onchangecallbacks[path](path, newvalue)
 
+	# Removes the tree nodes of the path which have no item left below them, the index
+	# tells so without looking at the other paths.
 	def _item_deleted(self, path):
 		self._dbusobjects.pop(path)
-		for np in list(self._dbusnodes.keys()):
-			if np != '/':
-				for ip in self._dbusobjects:
-					if ip.startswith(np + '/'):
-						break
-				else:
-					self._dbusnodes[np].__del__()
-					self._dbusnodes.pop(np)
+		self._unindex_path(path)
+		for np in self._parent_nodes(path)[1:]:
+			if np not in self._subtrees and np in self._dbusnodes:
+				self._dbusnodes[np].__del__()
+				self._dbusnodes.pop(np)
 
 	def __getitem__(self, path):
 		return self._dbusobjects[path].local_get_value()
@@ -393,7 +480,7 @@ class VeDbusTreeExport(dbus.service.Object):
 	def __init__(self, bus, objectPath, service):
 		dbus.service.Object.__init__(self, bus, objectPath)
 		self._service = service
-		logging.debug("VeDbusTreeExport %s has been created" % objectPath)
+		logging.debug("VeDbusTreeExport %s has been created", objectPath)
 
 	def __del__(self):
 		# self._get_path() will raise an exception when retrieved after the call to .remove_from_connection,
@@ -412,13 +499,10 @@ class VeDbusTreeExport(dbus.service.Object):
 	def _get_value_handler(self, path, get_text=False):
 		logging.debug("_get_value_handler called for %s" % path)
 		r = {}
-		px = path
-		if not px.endswith('/'):
-			px += '/'
-		for p, item in self._service._dbusobjects.items():
-			if p.startswith(px):
-				v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
-				r[p[len(px):]] = v
+		px = len(path) if path.endswith('/') else len(path) + 1
+		for p, item in self._service._subtree(path).items():
+			v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
+			r[p[px:]] = v
 		logging.debug(r)
 		return r
 
@@ -462,13 +546,17 @@ class VeDbusItemExport(dbus.service.Object):
 	# @param callback	  Function that will be called when someone else changes the value of this VeBusItem
 	#                     over the dbus. First parameter passed to callback will be our path, second the new
 	#					  value. This callback should return True to accept the change, False to reject it.
+	# @param signaltext   Include the Text in the PropertiesChanged signal. The text is rendered on
+	#                     first use and kept until the value changes.
 	def __init__(self, bus, objectPath, value=None, description=None, writeable=False,
 					onchangecallback=None, gettextcallback=None, deletecallback=None,
-					valuetype=None):
+					valuetype=None, signaltext=True):
 		dbus.service.Object.__init__(self, bus, objectPath)
 		self._onchangecallback = onchangecallback
 		self._gettextcallback = gettextcallback
 		self._value = value
+		self._text = None
+		self._signaltext = signaltext
 		self._description = description
 		self._writeable = writeable
 		self._deletecallback = deletecallback
@@ -505,10 +593,11 @@ class VeDbusItemExport(dbus.service.Object):
 			return None
 
 		self._value = newvalue
-		return {
-			'Value': wrap_dbus_value(newvalue),
-			'Text': self.GetText()
-		}
+		self._text = None
+		changes = {'Value': wrap_dbus_value(newvalue)}
+		if self._signaltext:
+			changes['Text'] = self.GetText()
+		return changes
 
 	def local_get_value(self):
 		return self._value
@@ -571,6 +660,11 @@ class VeDbusItemExport(dbus.service.Object):
 	# @return text A text-value. '---' when local value is invalid
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='s')
 	def GetText(self):
+		if self._text is None:
+			self._text = self._render_text()
+		return self._text
+
+	def _render_text(self):
 		if self._value is None:
 			return '---'
 
@@ -595,6 +689,205 @@ class VeDbusItemExport(dbus.service.Object):
 	def PropertiesChanged(self, changes):
 		pass
 
+# Alternative to VeDbusService which does not register a dbus.service.Object for every
+# path and every intermediate node. A single VeDbusFallbackExport is registered on '/' and
+# serves all the object paths of the service, dispatching the calls to light-weight
+# VeDbusVirtualItem objects. The com.victronenergy.BusItem interface seen on the bus is
+# the same, only the introspection data of the paths below '/' is not available.
+class VeDbusVirtualService(VeDbusService):
+	def _create_root(self):
+		return VeDbusFallbackExport(self._dbusconn, self)
+
+	def _create_item(self, path, value, description, writeable, gettextcallback, valuetype):
+		return VeDbusVirtualItem(self, path, value, description, writeable, gettextcallback, valuetype)
+
+	# the items have nothing registered on the bus, detaching them is enough
+	def _drop_items(self):
+		for item in self._dbusobjects.values():
+			item._service = None
+
+	# tree nodes are served by the fallback object, there is nothing to create
+	def _add_nodes(self, nodes, newpaths=()):
+		pass
+
+def _unknown_object(path):
+	return dbus.exceptions.DBusException('No such object path %s' % path,
+		name='org.freedesktop.DBus.Error.UnknownObject')
+
+def _unknown_method(path, method):
+	return dbus.exceptions.DBusException('No method %s on %s' % (method, path),
+		name='org.freedesktop.DBus.Error.UnknownMethod')
+
+class VeDbusFallbackExport(dbus.service.FallbackObject):
+	def __init__(self, bus, service):
+		dbus.service.FallbackObject.__init__(self, bus, '/')
+		self._service = service
+
+	def __del__(self):
+		if len(self._locations) == 0:
+			return
+		self.remove_from_connection()
+		logging.debug("VeDbusFallbackExport has been removed")
+
+	def _get_value_handler(self, path, get_text=False):
+		r = {}
+		px = len(path) if path.endswith('/') else len(path) + 1
+		for p, item in self._service._subtree(path).items():
+			v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
+			r[p[px:]] = v
+		if not r and path != '/':
+			raise _unknown_object(path)
+		return r
+
+	def _get_item(self, path, method):
+		try:
+			return self._service._dbusobjects[path]
+		except KeyError:
+			raise _unknown_method(path, method)
+
+	@dbus.service.method('com.victronenergy.BusItem', out_signature='v', rel_path_keyword='path')
+	def GetValue(self, path):
+		item = self._service._dbusobjects.get(path)
+		if item is not None:
+			return item.GetValue()
+		value = self._get_value_handler(path)
+		return dbus.Dictionary(value, signature=dbus.Signature('sv'), variant_level=1)
+
+	# Items return a string and tree nodes a variant holding a dictionary, so the signature
+	# is guessed by dbus-python from the returned value.
+	@dbus.service.method('com.victronenergy.BusItem', rel_path_keyword='path')
+	def GetText(self, path):
+		item = self._service._dbusobjects.get(path)
+		if item is not None:
+			return dbus.String(item.GetText())
+		text = self._get_value_handler(path, True)
+		return dbus.Dictionary(text, signature=dbus.Signature('ss'), variant_level=1)
+
+	@dbus.service.method('com.victronenergy.BusItem', in_signature='v', out_signature='i', rel_path_keyword='path')
+	def SetValue(self, newvalue, path):
+		return self._get_item(path, 'SetValue').SetValue(newvalue)
+
+	@dbus.service.method('com.victronenergy.BusItem', in_signature='si', out_signature='s', rel_path_keyword='path')
+	def GetDescription(self, language, length, path):
+		return self._get_item(path, 'GetDescription').GetDescription(language, length)
+
+	@dbus.service.method('com.victronenergy.BusItem', out_signature='a{sa{sv}}', rel_path_keyword='path')
+	def GetItems(self, path):
+		if path != '/':
+			raise _unknown_method(path, 'GetItems')
+		return {
+			p: {
+				'Value': wrap_dbus_value(item.local_get_value()),
+				'Text': item.GetText() }
+			for p, item in self._service._dbusobjects.items()
+		}
+
+	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sa{sv}}')
+	def ItemsChanged(self, changes):
+		pass
+
+	# Emitted on the object path of the item itself. The signal decorator of dbus-python
+	# cannot be used here: it would send the signal on the location of the fallback
+	# object followed by the path, '//Connected'.
+	def PropertiesChanged(self, changes, path):
+		for location in self.locations:
+			message = dbus.lowlevel.SignalMessage(path, 'com.victronenergy.BusItem',
+				'PropertiesChanged')
+			message.append(changes, signature='a{sv}')
+			location[0].send_message(message)
+
+# Value of one path of a VeDbusVirtualService, same behaviour as VeDbusItemExport. The
+# change and delete callbacks, the signal text option and the root object are those of
+# the service, which the item refers to instead of keeping its own copies.
+class VeDbusVirtualItem(object):
+	__slots__ = ('_service', '_path', '_value', '_text', '_description', '_writeable',
+		'_gettextcallback', '_type')
+
+	def __init__(self, service, path, value=None, description=None, writeable=False,
+					gettextcallback=None, valuetype=None):
+		self._service = service
+		self._path = path
+		self._value = value
+		self._text = None
+		self._description = description
+		self._writeable = writeable
+		self._gettextcallback = gettextcallback
+		self._type = valuetype
+
+	# Same as VeDbusItemExport, explicitly call __del__() to remove the path.
+	def __del__(self):
+		service, self._service = self._service, None
+		if service is None:
+			return
+		service._item_deleted(self._path)
+		logging.debug("VeDbusVirtualItem %s has been removed", self._path)
+
+	def local_set_value(self, newvalue):
+		changes = self._local_set_value(newvalue)
+		if changes is not None:
+			self._service._dbusnodes['/'].PropertiesChanged(changes, self._path)
+
+	def _local_set_value(self, newvalue):
+		if self._value == newvalue:
+			return None
+
+		self._value = newvalue
+		self._text = None
+		changes = {'Value': wrap_dbus_value(newvalue)}
+		if self._service._signaltext:
+			changes['Text'] = self.GetText()
+		return changes
+
+	def local_get_value(self):
+		return self._value
+
+	def SetValue(self, newvalue):
+		if not self._writeable:
+			return 1  # NOT OK
+
+		newvalue = unwrap_dbus_value(newvalue)
+
+		if self._type is not None and newvalue is not None:
+			try:
+				newvalue = self._type(newvalue)
+			except (ValueError, TypeError):
+				return 1 # NOT OK
+
+		if newvalue == self._value:
+			return 0  # OK
+
+		if self._service._value_changed(self._path, newvalue):
+			self.local_set_value(newvalue)
+			return 0  # OK
+
+		return 2  # NOT OK
+
+	def GetDescription(self, language, length):
+		return self._description if self._description is not None else 'No description given'
+
+	def GetValue(self):
+		return wrap_dbus_value(self._value)
+
+	def GetText(self):
+		if self._text is None:
+			self._text = self._render_text()
+		return self._text
+
+	def _render_text(self):
+		if self._value is None:
+			return '---'
+
+		if self._gettextcallback is None and type(self._value) == dbus.Byte:
+			return str(int(self._value))
+
+		if self._gettextcallback is None and self._path == '/ProductId':
+			return "0x%X" % self._value
+
+		if self._gettextcallback is None:
+			return str(self._value)
+
+		return self._gettextcallback(self._path, self._value)
+
 ## This class behaves like a regular reference to a class method (eg. self.foo), but keeps a weak reference
 ## to the object which method is to be called.
 ## Use this object to break circular references.
@@ -609,3 +902,189 @@ class weak_functor:
 		if r == None or f == None:
 			return
 		f(r, *args, **kargs)
+
+
+# Benchmark of the creation of device services with add_path and add_paths.
+# Needs a D-Bus daemon: the session bus is used when DBUS_SESSION_BUS_ADDRESS is set.
+if __name__ == '__main__':
+	import time
+	from dbus.mainloop.glib import DBusGMainLoop
+
+	DBusGMainLoop(set_as_default=True)
+
+	# logging as set up by homedub: debug lines are not written, but add_path still formats
+	# its own
+	logging.basicConfig(level=logging.INFO)
+
+	# each service gets a connection of its own, as done by ModbusDevice.init: a connection
+	# can only have one object registered on '/'
+	def private_bus():
+		if 'DBUS_SESSION_BUS_ADDRESS' in os.environ:
+			return dbus.SessionBus(private=True)
+		return dbus.SystemBus(private=True)
+
+	def close(service):
+		service.__del__()
+		service.dbusconn.close()
+
+	# check that a value set on a virtual service, locally or with SetValue, is signalled
+	# on the object path of its item
+	from gi.repository import GLib
+
+	name = 'com.victronenergy.grid.check_virtual'
+	s = VeDbusVirtualService(name, private_bus())
+	s.add_paths([('/Connected', 1), ('/CustomName', '', dict(writeable=True))])
+
+	signals = []
+	replies = []
+	client = private_bus()
+	client.add_signal_receiver(
+		lambda changes, path: signals.append((str(path), unwrap_dbus_value(changes['Value']))),
+		'PropertiesChanged', 'com.victronenergy.BusItem', name, path_keyword='path')
+
+	s['/Connected'] = 0
+	client.get_object(name, '/CustomName').SetValue('Meter',
+		reply_handler=replies.append, error_handler=replies.append)
+
+	loop = GLib.MainLoop()
+	GLib.timeout_add(500, loop.quit)
+	loop.run()
+
+	assert replies == [0], replies
+	assert signals == [('/Connected', 0), ('/CustomName', 'Meter')], signals
+	print('virtual service: PropertiesChanged on %s' % ', '.join(p for p, v in signals))
+	close(s)
+	client.close()
+
+	# paths exported by a SunSpec meter
+	paths = ['/Mgmt/ProcessName', '/Mgmt/ProcessVersion', '/Mgmt/Connection',
+		'/DeviceInstance', '/ProductId', '/ProductName', '/Model', '/Connected',
+		'/AllowedRoles', '/Role', '/FirmwareVersion', '/Serial', '/CustomName',
+		'/Ac/Current', '/Ac/L1/Current', '/Ac/Voltage', '/Ac/L1/Voltage',
+		'/Ac/Frequency', '/Ac/Power', '/Ac/L1/Power', '/Ac/Energy/Forward',
+		'/Ac/Energy/Reverse', '/Ac/L1/Energy/Forward']
+
+	# time spent registering the paths of n devices, the best of 5 runs: the creation of the
+	# services and their bus connections is left out, it is the same with both methods
+	def bring_up(cls, n, bulk):
+		best = None
+		for run in range(5):
+			services = [cls('com.victronenergy.grid.bench_%d' % i, private_bus())
+				for i in range(n)]
+			t0 = time.time()
+			for s in services:
+				if bulk:
+					s.add_paths([(p, 0) for p in paths])
+				else:
+					for p in paths:
+						s.add_path(p, 0)
+			t = time.time() - t0
+			for s in services:
+				close(s)
+			best = t if best is None else min(best, t)
+		return best
+
+	for cls in (VeDbusService, VeDbusVirtualService):
+		for n in (1, 10, 100):
+			t0 = bring_up(cls, n, False)
+			t1 = bring_up(cls, n, True)
+			print('%-20s %3d devices: add_path %8.2f ms, add_paths %8.2f ms' % (
+				cls.__name__, n, t0 * 1e3, t1 * 1e3))
+
+	# memory held per path, 1000 paths below 100 nodes: items, tree nodes and index
+	import gc
+	import tracemalloc
+
+	for cls in (VeDbusService, VeDbusVirtualService):
+		s = cls('com.victronenergy.grid.bench_memory', private_bus())
+		devpaths = [('/Pv/%d/%d' % (i // 10, i % 10), i) for i in range(1000)]
+		gc.collect()
+		tracemalloc.start()
+		s.add_paths(devpaths)
+		gc.collect()
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		print('%-20s %5d bytes per path' % (cls.__name__, size / len(devpaths)))
+		close(s)
+
+	# tree reads on a service with 1000 paths, against a scan of all the paths
+	def scan(service, path):
+		px = path if path.endswith('/') else path + '/'
+		return {p[len(px):]: wrap_dbus_value(item.local_get_value())
+			for p, item in service._dbusobjects.items() if p.startswith(px)}
+
+	s = VeDbusService('com.victronenergy.grid.bench_tree', private_bus())
+	s.add_paths([('/Pv/%d/%s' % (i, q), i) for i in range(100)
+		for q in ('V', 'I', 'P', 'Yield', 'Energy/Forward', 'Energy/Reverse',
+			'MppOperationMode', 'State', 'Name', 'Temperature')])
+	root = s._dbusnodes['/']
+	for node in ('/', '/Pv', '/Pv/42', '/Pv/42/Energy'):
+		n = 1000 if node.count('/') > 1 else 100
+		t0 = time.time()
+		for i in range(n):
+			scan(s, node)
+		t1 = time.time()
+		for i in range(n):
+			root._get_value_handler(node)
+		t2 = time.time()
+		print('GetValue %-14s scan %8.1f us, index %8.1f us' % (
+			node, (t1 - t0) / n * 1e6, (t2 - t1) / n * 1e6))
+	close(s)
+
+	# removal of the paths of endpoints one at a time with del, as done by remove_health,
+	# against the previous scan of all nodes for each removed path
+	class ScanService(VeDbusService):
+		def _item_deleted(self, path):
+			self._dbusobjects.pop(path)
+			self._unindex_path(path)
+			for np in list(self._dbusnodes.keys()):
+				if np != '/':
+					for ip in self._dbusobjects:
+						if ip.startswith(np + '/'):
+							break
+					else:
+						self._dbusnodes[np].__del__()
+						self._dbusnodes.pop(np)
+
+	def remove(cls, n):
+		s = cls('com.victronenergy.grid.bench_remove', private_bus())
+		s.add_paths([('/Endpoints/%d/%s' % (i, p), 0) for i in range(n)
+			for p in ('Endpoint', 'State', 'Errors')])
+		t0 = time.time()
+		for i in range(n):
+			for p in ('Endpoint', 'State', 'Errors'):
+				del s['/Endpoints/%d/%s' % (i, p)]
+		t = time.time() - t0
+		assert list(s._dbusnodes) == ['/'] and not s._subtrees
+		close(s)
+		return t
+
+	for n in (10, 50, 200):
+		print('del %4d endpoints: scan %8.1f ms, index %8.1f ms' % (
+			n, remove(ScanService, n) * 1e3, remove(VeDbusService, n) * 1e3))
+
+	# destroy of a whole service, against removing each item through its delete callback
+	class UnindexService(VeDbusService):
+		def __del__(self):
+			for node in list(self._dbusnodes.values()):
+				node.__del__()
+			self._dbusnodes.clear()
+			for item in list(self._dbusobjects.values()):
+				item.__del__()
+			self._subtrees.clear()
+			if self._dbusname:
+				self._dbusname.__del__()
+			self._dbusname = None
+
+	def destroy(cls, n):
+		s = cls('com.victronenergy.grid.bench_destroy', private_bus())
+		s.add_paths([('/Pv/%d/%s' % (i // 10, i % 10), i) for i in range(n)])
+		t0 = time.time()
+		s.__del__()
+		t = time.time() - t0
+		s.dbusconn.close()
+		return t
+
+	for n in (100, 1600):
+		print('destroy %4d paths: per item %8.1f ms, detached %8.1f ms' % (
+			n, destroy(UnindexService, n) * 1e3, destroy(VeDbusService, n) * 1e3))